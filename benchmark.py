@@ -0,0 +1,240 @@
+"""
+Author: Resul Emre AYGAN
+"""
+
+import subprocess
+import sys
+from datetime import datetime
+from os import path
+from sys import argv
+from tempfile import mkdtemp
+from time import perf_counter
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from coco_operations import model_class
+from geometry_operations import bounds_to_polygon, transform_polygon_osr, save_gdf_to_shapefile
+from raster_operations import encode_raster_as_png, png_backends, save_array_as_raster, raster_profiles, \
+    raster_compressions, get_array_from_raster, close_raster
+from utils.file_operations import write_json, load_json, generate_dir, file_exists, get_file_size
+
+repo_dir = path.dirname(path.abspath(__file__))
+
+# scene center in EPSG:4326, every scenario is generated around it
+scene_center = (36.93, 37.58)
+meters_per_degree = 111320
+
+benchmark_scenarios = [
+    {"name": "rgb_4326", "width": 4096, "height": 4096, "band_count": 3, "epsg": 4326, "building_count": 2000},
+    {"name": "rgba_4326", "width": 4096, "height": 4096, "band_count": 4, "epsg": 4326, "building_count": 2000},
+    {"name": "rgb_3857", "width": 4096, "height": 4096, "band_count": 3, "epsg": 3857, "building_count": 2000},
+    {"name": "rgb_32637", "width": 8192, "height": 8192, "band_count": 3, "epsg": 32637, "building_count": 8000},
+]
+
+
+def time_function(function, repeat, **params):
+    durations = []
+    result = None
+
+    for _ in range(repeat):
+        start_time = perf_counter()
+        result = function(**params)
+        durations.append(perf_counter() - start_time)
+
+    return {"best_seconds": min(durations), "mean_seconds": sum(durations) / len(durations)}, result
+
+
+def generate_synthetic_tile(width, height, band_count, seed=0):
+    # a smooth gradient with some noise compresses more like real imagery than pure noise
+    random_generator = np.random.default_rng(seed)
+    gradient = np.add.outer(np.arange(height), np.arange(width)) * (255 / (width + height))
+    noise = random_generator.integers(0, 32, size=(height, width, band_count))
+
+    return np.clip(gradient[:, :, np.newaxis] + noise, 0, 255).astype(np.uint8)
+
+
+def get_scene_bounds(width, height, resolution):
+    half_width = width * resolution / meters_per_degree / 2
+    half_height = height * resolution / meters_per_degree / 2
+
+    return (scene_center[0] - half_width, scene_center[1] - half_height,
+            scene_center[0] + half_width, scene_center[1] + half_height)
+
+
+def generate_synthetic_scene(output_path, width, height, band_count, epsg, resolution=0.5, seed=0):
+    scene_bounds = get_scene_bounds(width=width, height=height, resolution=resolution)
+
+    if epsg != 4326:
+        scene_bounds = transform_polygon_osr(polygon=bounds_to_polygon(geom_bounds=scene_bounds), src_epsg=4326,
+                                             dst_epsg=epsg).bounds
+
+    geo_transform = (scene_bounds[0], (scene_bounds[2] - scene_bounds[0]) / width, 0.0,
+                     scene_bounds[3], 0.0, -(scene_bounds[3] - scene_bounds[1]) / height)
+
+    raster_array = generate_synthetic_tile(width=width, height=height, band_count=min(band_count, 3), seed=seed)
+    alpha_channel = None
+
+    if band_count > 3:
+        alpha_channel = np.full((height, width), 255, dtype=np.uint8)
+
+    save_array_as_raster(raster_array=raster_array, output_path=output_path, geo_transform=geo_transform, epsg=epsg,
+                         raster_format='GTiff', alpha_channel=alpha_channel)
+
+    return output_path
+
+
+def generate_synthetic_footprints(output_path, width, height, building_count, resolution=0.5, seed=0):
+    random_generator = np.random.default_rng(seed)
+    min_x, min_y, max_x, max_y = get_scene_bounds(width=width, height=height, resolution=resolution)
+
+    # rotated rectangles of 8-30 m, the shapefile is always EPSG:4326 like the real footprints
+    centers = np.column_stack([random_generator.uniform(min_x, max_x, building_count),
+                               random_generator.uniform(min_y, max_y, building_count)])
+    sizes = random_generator.uniform(8, 30, size=(building_count, 2)) / meters_per_degree / 2
+    angles = random_generator.uniform(0, np.pi, building_count)
+
+    corners = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]])[np.newaxis] * sizes[:, np.newaxis]
+    rotation = np.stack([np.stack([np.cos(angles), -np.sin(angles)], axis=1),
+                         np.stack([np.sin(angles), np.cos(angles)], axis=1)], axis=1)
+    corners = np.einsum('nij,nkj->nki', rotation, corners) + centers[:, np.newaxis]
+
+    footprints = gpd.GeoDataFrame({"damage_gra": random_generator.choice(list(model_class.keys()),
+                                                                         size=building_count)},
+                                  geometry=shapely.polygons(corners), crs='EPSG:4326')
+
+    save_gdf_to_shapefile(output_path=output_path, epsg=4326, gdf_data=footprints)
+
+    return output_path
+
+
+def get_commit_id():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=repo_dir, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def benchmark_png_encoders(width=2048, height=2048, repeat=3, png_compression=6):
+    tile_array = generate_synthetic_tile(width=width, height=height, band_count=4)
+
+    results = []
+
+    for png_backend in png_backends:
+        timings, png_bytes = time_function(encode_raster_as_png, repeat=repeat, raster_array=tile_array,
+                                           generate_alpha=False, normalize=False, png_backend=png_backend,
+                                           png_compression=png_compression)
+
+        results.append({"backend": png_backend, "width": width, "height": height, "bands": 4,
+                        "png_compression": png_compression, "size_bytes": len(png_bytes), **timings})
+
+        print(f'{png_backend}: {timings["best_seconds"]:.3f} sn, {len(png_bytes)} byte')
+
+    return results
+
+
+def read_raster_file(file_path, window=None):
+    # the cached handle is dropped so every read pays for opening the file like a training loader would
+    close_raster(file_path=file_path)
+
+    return get_array_from_raster(file_path=file_path, only_info=False, window=window)
+
+
+def benchmark_raster_profiles(work_dir, width=2048, height=2048, repeat=3, window_size=512):
+    generate_dir(dir_path=work_dir)
+
+    tile_array = generate_synthetic_tile(width=width, height=height, band_count=3)
+    scene_bounds = get_scene_bounds(width=width, height=height, resolution=0.5)
+    geo_transform = (scene_bounds[0], 0.5 / meters_per_degree, 0.0, scene_bounds[3], 0.0, -0.5 / meters_per_degree)
+    window = ((width - window_size) // 2, (height - window_size) // 2, window_size, window_size)
+
+    results = []
+
+    for raster_profile in raster_profiles:
+        for raster_compression in raster_compressions:
+            output_path = path.join(work_dir, f'{raster_profile}_{raster_compression.lower()}.tif')
+
+            write_timings, _ = time_function(save_array_as_raster, repeat=repeat, raster_array=tile_array,
+                                             output_path=output_path, geo_transform=geo_transform, epsg=4326,
+                                             raster_format='GTiff', raster_profile=raster_profile,
+                                             raster_compression=raster_compression)
+            read_timings, _ = time_function(read_raster_file, repeat=repeat, file_path=output_path)
+            window_timings, _ = time_function(read_raster_file, repeat=repeat, file_path=output_path, window=window)
+
+            results.append({"raster_profile": raster_profile, "raster_compression": raster_compression,
+                            "width": width, "height": height, "size_bytes": get_file_size(file_path=output_path),
+                            "write": write_timings, "read": read_timings, "window_read": window_timings})
+
+            print(f'{raster_profile}/{raster_compression}: {get_file_size(file_path=output_path)} byte, yazma '
+                  f'{write_timings["best_seconds"]:.3f} sn, okuma {read_timings["best_seconds"]:.3f} sn, pencere '
+                  f'{window_timings["best_seconds"]:.3f} sn')
+
+    return results
+
+
+def benchmark_scenario(scenario, work_dir, config_overrides=None):
+    scenario_dir = path.join(work_dir, scenario["name"])
+    output_dir = path.join(scenario_dir, "output")
+    generate_dir(dir_path=output_dir)
+
+    raster_path = generate_synthetic_scene(output_path=path.join(scenario_dir, "scene.tif"),
+                                           width=scenario["width"], height=scenario["height"],
+                                           band_count=scenario["band_count"], epsg=scenario["epsg"])
+    shape_path = generate_synthetic_footprints(output_path=path.join(scenario_dir, "footprints.shp"),
+                                               width=scenario["width"], height=scenario["height"],
+                                               building_count=scenario["building_count"])
+
+    # main.py reads config.json from its working directory, every scenario gets its own copy
+    config = load_json(json_path=path.join(repo_dir, "config.json"))
+    config.update({"raster_path": raster_path, "output_dir": output_dir, "shape_path": shape_path,
+                   "visualize_coco": False, "profile_stages": []})
+    config.update(config_overrides or {})
+    write_json(output_path=path.join(scenario_dir, "config.json"), json_data=config)
+
+    start_time = perf_counter()
+    process = subprocess.run([sys.executable, path.join(repo_dir, "main.py")], cwd=scenario_dir,
+                             capture_output=True, text=True)
+    wall_seconds = perf_counter() - start_time
+
+    metrics_path = path.join(output_dir, "scene_metrics.json")
+
+    result = {**scenario, "config": config_overrides or {}, "wall_seconds": wall_seconds,
+              "return_code": process.returncode, "metrics": None}
+
+    if file_exists(file_path=metrics_path):
+        result["metrics"] = load_json(json_path=metrics_path)
+    else:
+        print(f'{scenario["name"]} senaryosu hatali tamamlandi! - {process.stderr[-2000:]}')
+
+    print(f'{scenario["name"]}: {wall_seconds:.2f} sn - {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
+
+    return result
+
+
+def run_benchmarks(output_path, scenarios=None, config_overrides=None, work_dir=None):
+    work_dir = work_dir or mkdtemp(prefix="benchmark_")
+
+    results = {"commit": get_commit_id(), "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+               "work_dir": work_dir, "png_encoders": benchmark_png_encoders(),
+               "raster_profiles": benchmark_raster_profiles(work_dir=path.join(work_dir, "raster_profiles")),
+               "scenarios": []}
+
+    for scenario in scenarios or benchmark_scenarios:
+        results["scenarios"].append(benchmark_scenario(scenario=scenario, work_dir=work_dir,
+                                                       config_overrides=config_overrides))
+
+    write_json(output_path=output_path, json_data=results)
+
+    return results
+
+
+if __name__ == '__main__':
+    print(f'Benchmark basladi - {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
+
+    output_path = argv[1] if len(argv) > 1 else 'benchmark_results.json'
+
+    run_benchmarks(output_path=path.abspath(output_path))
+
+    print(f'Benchmark tamamlandi. {output_path} - {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
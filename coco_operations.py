@@ -2,17 +2,24 @@
 Author: Resul Emre AYGAN
 """
 
+import gzip
 import json
 import os.path
-import re
 from datetime import datetime
+from io import BytesIO
+from textwrap import indent
 
 import matplotlib.pyplot as plt
 import numpy as np
+import shapely
 from PIL import Image, ImageDraw
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from skimage import measure
 
-from geometry_operations import Polygon
+from utils.metric_operations import profile_stage, add_counter
+from utils.shard_operations import read_shard_file, is_shard_path
 
 model_class = {"No visible damage": "undamaged", "Destroyed": "damaged",
                "Possibly damaged": "uncertain", "Damaged": "uncertain", "": "buildings"}
@@ -66,118 +73,281 @@ def write_categories(categories_list):
     return categories_dict
 
 
-def write_images(image_list, width=0, height=0):
-    images_dict = {"images": []}
-    images_ids = {}
+def get_category_masks(label_array, category_names, categories):
+    # every category is burnt into one label raster, a single buildings category covers all its labels
+    if category_names:
+        return {category_name: label_array == categories[category_name]['id'] for category_name in category_names}
+    elif 'buildings' in categories.keys():
+        return {'buildings': label_array > 0}
+    else:
+        return {}
+
+
+@profile_stage(stage_name="coco_contours")
+def create_label_annotations(category_masks, image_id, is_crowd, categories, annotation_id=1):
+    annotations = []
+
+    for category_name, category_mask in category_masks.items():
+        if not category_mask.any():
+            continue
+
+        # 1 pixel padding so contours of buildings touching the tile border are closed
+        sub_mask = np.pad(category_mask, 1)
+
+        annotation_id, annotations_new = create_sub_mask_annotation(sub_mask=sub_mask, image_id=image_id,
+                                                                    category_id=categories[category_name]["id"],
+                                                                    annotation_id=annotation_id,
+                                                                    is_crowd=is_crowd)
+        annotations += annotations_new
+
+    return annotation_id, annotations
+
+
+@profile_stage(stage_name="coco_components")
+def create_component_annotations(instance_array, instance_categories, image_id, is_crowd, annotation_id=1):
+    # pixels of one instance that touch each other form a component, touching instances stay apart
+    component_array = measure.label(instance_array, background=0, connectivity=1)
+
+    contours = []
+    category_ids = []
+
+    for component_index, component_slice in enumerate(ndimage.find_objects(component_array), start=1):
+        if component_slice is None:
+            continue
+
+        component_mask = component_array[component_slice] == component_index
+        category_id = instance_categories[instance_array[component_slice][component_mask][0]]
+
+        if category_id == 0:
+            continue
+
+        # contours are only traced inside the component's bbox and moved back to tile pixels afterwards
+        component_offset = (component_slice[0].start, component_slice[1].start)
 
-    for index, file in enumerate(image_list):
-        if width != 0 or height != 0:
-            img = Image.open(file)
-            width, height = img.size
+        for contour in measure.find_contours(np.pad(component_mask, 1), 0.5, positive_orientation="low"):
+            contours.append(contour + component_offset)
+            category_ids.append(category_id)
 
-        file_name = os.path.split(file)[1]
+    return create_contour_annotations(contours=contours, category_ids=category_ids, image_id=image_id,
+                                      annotation_id=annotation_id, is_crowd=is_crowd)
 
-        image = {"id": index + 1, "width": width, "height": height, "file_name": file_name}
 
-        images_dict["images"].append(image)
+@profile_stage(stage_name="coco_vectors")
+def create_vector_annotations(geometries, category_ids, image_id, is_crowd, annotation_id=1):
+    annotations = []
+
+    # multipart footprints and clip results are split into polygons, lines and points left by the clip are dropped
+    parts, part_indices = shapely.get_parts(geometries, return_index=True)
+    is_polygon = shapely.get_type_id(parts) == 3
+    parts = parts[is_polygon]
+    part_indices = part_indices[is_polygon]
+
+    if not len(parts):
+        return annotation_id, annotations
+
+    exteriors = shapely.get_exterior_ring(parts)
+    exterior_coords = np.split(shapely.get_coordinates(exteriors).ravel(),
+                               np.cumsum(shapely.get_num_coordinates(exteriors) * 2)[:-1])
+
+    geometry_indices, part_starts = np.unique(part_indices, return_index=True)
+    part_bounds = shapely.bounds(parts)
+    geometry_bounds = np.hstack([np.minimum.reduceat(part_bounds[:, :2], part_starts),
+                                 np.maximum.reduceat(part_bounds[:, 2:], part_starts)])
+    geometry_bounds[:, 2:] -= geometry_bounds[:, :2]
+    # COCO polygons have no holes, the area is the one the exterior rings in segmentation cover
+    geometry_areas = np.bincount(part_indices, weights=shapely.area(shapely.polygons(exteriors)))[geometry_indices]
+
+    part_ends = np.append(part_starts[1:], len(parts))
+
+    for geometry_index, part_start, part_end, bbox, area in zip(geometry_indices.tolist(), part_starts.tolist(),
+                                                               part_ends.tolist(), geometry_bounds.tolist(),
+                                                               geometry_areas.tolist()):
+        category_id = category_ids[geometry_index]
+
+        if category_id == 0:
+            continue
+
+        annotation = {
+            "segmentation": [ring.tolist() for ring in exterior_coords[part_start:part_end]],
+            "iscrowd": int(is_crowd),
+            "image_id": int(image_id),
+            "category_id": int(category_id),
+            "id": int(annotation_id),
+            "bbox": tuple(bbox),
+            "area": area,
+        }
+
+        annotation_id += 1
+        annotations.append(annotation)
+
+    add_counter(counter_name="annotations", value=len(annotations))
+
+    return annotation_id, annotations
+
+
+def get_annotation_geometries(coco_tiles):
+    ring_coords = []
+    ring_annotations = []
+    annotation_tiles = []
+    annotation_categories = []
 
-        images_ids[file_name] = index + 1
+    # segmentation rings are tile pixels, the tile geotransform moves them into the scene's coordinates
+    for tile_index, coco_tile in enumerate(coco_tiles):
+        x_origin, res_x, _, y_origin, _, res_y = coco_tile["geo_transform"]
 
-    return images_dict, images_ids
+        for annotation in coco_tile["annotations"]:
+            for segmentation in annotation["segmentation"]:
+                ring_coords.append(np.asarray(segmentation).reshape(-1, 2) * (res_x, res_y) + (x_origin, y_origin))
+                ring_annotations.append(len(annotation_tiles))
 
+            annotation_tiles.append(tile_index)
+            annotation_categories.append(annotation["category_id"])
 
-def create_sub_masks(mask_image, colors):
-    width, height = mask_image.size
+    if not ring_coords:
+        return np.empty(0, dtype=object), np.asarray(annotation_tiles), np.asarray(annotation_categories)
 
-    sub_masks = {}
+    ring_lengths = [len(coords) for coords in ring_coords]
+    polys = shapely.polygons(shapely.linearrings(np.concatenate(ring_coords),
+                                                 indices=np.repeat(np.arange(len(ring_coords)), ring_lengths)))
 
-    for x in range(width):
-        for y in range(height):
-            pixel = mask_image.getpixel((x, y))
+    # simplified contours can cross themselves, intersections need valid polygons
+    polys = shapely.make_valid(polys)
 
-            if pixel in colors:
-                sub_mask = sub_masks.get(pixel)
-                if sub_mask is None:
-                    sub_masks[pixel] = Image.new("1", (width + 2, height + 2))
+    # multipart footprints from the vectors engine have one ring per part
+    annotation_starts = np.searchsorted(ring_annotations, np.arange(1, len(annotation_tiles)))
+    geometries = np.array([parts[0] if len(parts) == 1 else shapely.union_all(parts)
+                           for parts in np.split(polys, annotation_starts)], dtype=object)
 
-                sub_masks[pixel].putpixel((x + 1, y + 1), 1)
+    return geometries, np.asarray(annotation_tiles), np.asarray(annotation_categories)
 
-    return sub_masks
 
+@profile_stage(stage_name="coco_dedup")
+def deduplicate_tile_annotations(coco_tiles, min_overlap=0.5, area_tolerance=0.99):
+    geometries, annotation_tiles, annotation_categories = get_annotation_geometries(coco_tiles=coco_tiles)
 
-def write_annotations(label_list, images_ids, is_crowd, categories):
-    annotations_dict = {"annotations": []}
+    if not len(geometries):
+        return [coco_tile["annotations"] for coco_tile in coco_tiles]
 
-    annotation_id = 1
+    tile_scenes = np.unique([coco_tile["scene"] for coco_tile in coco_tiles], return_inverse=True)[1]
+    annotation_scenes = tile_scenes[annotation_tiles]
+    areas = shapely.area(geometries)
 
-    colors = [tuple(group["rgb"]) for group in categories.values()]
+    # candidate pairs come from the spatial index, only copies in another tile of the same scene can be duplicates
+    left, right = shapely.STRtree(geometries).query(geometries, predicate='intersects')
+    is_candidate = ((left < right) & (annotation_tiles[left] != annotation_tiles[right]) &
+                    (annotation_scenes[left] == annotation_scenes[right]) &
+                    (annotation_categories[left] == annotation_categories[right]))
+    left, right = left[is_candidate], right[is_candidate]
 
-    for file in label_list:
-        print(file)
+    # a fragment cut at a tile border lies inside the full building, so the overlap is measured on the smaller one
+    overlap_areas = shapely.area(shapely.intersection(geometries[left], geometries[right]))
+    is_duplicate = overlap_areas >= min_overlap * np.minimum(areas[left], areas[right])
 
-        mask = Image.open(file)
-        mask = mask.convert("RGB")
+    duplicate_graph = coo_matrix((np.ones(is_duplicate.sum()), (left[is_duplicate], right[is_duplicate])),
+                                 shape=(len(geometries), len(geometries)))
+    _, building_labels = connected_components(duplicate_graph, directed=False)
 
-        sub = create_sub_masks(mask_image=mask, colors=colors)
+    # the best covered copy is the largest one, copies of about the same size prefer the tile they are centered in
+    building_areas = np.zeros(building_labels.max() + 1)
+    np.maximum.at(building_areas, building_labels, areas)
+    is_covered = areas >= area_tolerance * building_areas[building_labels]
 
-        file_name = re.sub('_seg', '', os.path.split(file)[1])
+    tile_bounds = np.array([(coco_tile["geo_transform"][0], coco_tile["geo_transform"][3],
+                             coco_tile["geo_transform"][1] * coco_tile["width"],
+                             coco_tile["geo_transform"][5] * coco_tile["height"]) for coco_tile in coco_tiles])
+    tile_centers = tile_bounds[:, :2] + tile_bounds[:, 2:] / 2
+    geometry_bounds = shapely.bounds(geometries)
+    geometry_centers = (geometry_bounds[:, :2] + geometry_bounds[:, 2:]) / 2
+    center_offsets = np.abs((geometry_centers - tile_centers[annotation_tiles]) /
+                            np.maximum(np.abs(tile_bounds[annotation_tiles, 2:]), 1e-12)).max(axis=1)
 
-        # image_id = images_ids[file_name]
+    building_order = np.lexsort((center_offsets, ~is_covered, building_labels))
+    _, building_starts = np.unique(building_labels[building_order], return_index=True)
 
-        annotations = []
+    is_kept = np.zeros(len(geometries), dtype=bool)
+    is_kept[building_order[building_starts]] = True
 
-        for rgb, sub_mask in sub.items():
-            for key, value in categories.items():
-                if tuple(value["rgb"]) == rgb:
-                    file_name = re.sub('_' + key, '', file_name)
-                    category_id = value["id"]
-                    image_id = images_ids[file_name]
-                    break
+    add_counter(counter_name="annotations_deduplicated", value=len(geometries) - is_kept.sum())
 
-            last_annotation_id, annotations_new = create_sub_mask_annotation(sub_mask=sub_mask, image_id=image_id,
-                                                                             category_id=category_id,
-                                                                             annotation_id=annotation_id,
-                                                                             is_crowd=is_crowd)
-            annotation_id = last_annotation_id + 1
-            annotations += annotations_new
+    tile_annotations = []
+    annotation_index = 0
 
-        annotations_dict["annotations"] += annotations
+    for coco_tile in coco_tiles:
+        tile_kept = is_kept[annotation_index:annotation_index + len(coco_tile["annotations"])]
+        tile_annotations.append([annotation for annotation, kept in zip(coco_tile["annotations"], tile_kept) if kept])
+        annotation_index += len(coco_tile["annotations"])
 
-    return annotations_dict
+    return tile_annotations
+
+
+def scale_annotations(annotations, factor, pixel_offset=0.0):
+    level_annotations = []
+
+    for annotation in annotations:
+        bbox = annotation["bbox"]
+
+        level_annotations.append({
+            **annotation,
+            "segmentation": [((np.asarray(segmentation) + pixel_offset) / factor - pixel_offset).tolist()
+                             for segmentation in annotation["segmentation"]],
+            "bbox": ((bbox[0] + pixel_offset) / factor - pixel_offset, (bbox[1] + pixel_offset) / factor - pixel_offset,
+                     bbox[2] / factor, bbox[3] / factor),
+            "area": annotation["area"] / factor ** 2,
+        })
+
+    return level_annotations
 
 
 def create_sub_mask_annotation(sub_mask, image_id, category_id, annotation_id, is_crowd):
     contours = measure.find_contours(sub_mask, 0.5, positive_orientation="low")
 
+    return create_contour_annotations(contours=contours, category_ids=[category_id] * len(contours),
+                                      image_id=image_id, annotation_id=annotation_id, is_crowd=is_crowd)
+
+
+def create_contour_annotations(contours, category_ids, image_id, annotation_id, is_crowd):
     annotations = []
-    for contour in contours:
-        for i in range(len(contour)):
-            row, col = contour[i]
-            contour[i] = (col - 1, row - 1)
-
-        poly = Polygon(contour)
-        poly = poly.simplify(1.0, preserve_topology=False)
-        if not poly.is_empty:
-            segmentation = np.array(poly.exterior.coords).ravel().tolist()
-
-            x, y, max_x, max_y = poly.bounds
-            width = max_x - x
-            height = max_y - y
-            bbox = (x, y, width, height)
-            area = poly.area
-
-            annotation = {
-                "segmentation": [segmentation],
-                "iscrowd": int(is_crowd),
-                "image_id": int(image_id),
-                "category_id": int(category_id),
-                "id": int(annotation_id),
-                "bbox": bbox,
-                "area": area,
-            }
-
-            annotation_id += 1
-            annotations.append(annotation)
+
+    if not contours:
+        return annotation_id, annotations
+
+    # all contours go through shapely as one batch, (row, col) -> (col - 1, row - 1) removes the mask padding
+    contour_lengths = [len(contour) for contour in contours]
+    contour_coords = np.concatenate(contours)[:, ::-1] - 1
+    contour_indices = np.repeat(np.arange(len(contours)), contour_lengths)
+
+    polys = shapely.polygons(shapely.linearrings(contour_coords, indices=contour_indices))
+    polys = shapely.simplify(polys, 1.0, preserve_topology=False)
+
+    not_empty = ~shapely.is_empty(polys)
+    polys = polys[not_empty]
+    category_ids = np.asarray(category_ids)[not_empty].tolist()
+
+    if not len(polys):
+        return annotation_id, annotations
+
+    exteriors = shapely.get_exterior_ring(polys)
+    exterior_coords = np.split(shapely.get_coordinates(exteriors).ravel(),
+                               np.cumsum(shapely.get_num_coordinates(exteriors) * 2)[:-1])
+    poly_bounds = shapely.bounds(polys)
+    poly_bounds[:, 2:] -= poly_bounds[:, :2]
+    poly_areas = shapely.area(polys).tolist()
+
+    for segmentation, bbox, area, category_id in zip(exterior_coords, poly_bounds.tolist(), poly_areas, category_ids):
+        annotation = {
+            "segmentation": [segmentation.tolist()],
+            "iscrowd": int(is_crowd),
+            "image_id": int(image_id),
+            "category_id": int(category_id),
+            "id": int(annotation_id),
+            "bbox": tuple(bbox),
+            "area": area,
+        }
+
+        annotation_id += 1
+        annotations.append(annotation)
+
+    add_counter(counter_name="annotations", value=len(annotations))
 
     last_annotation_id = annotation_id
     return last_annotation_id, annotations
@@ -188,23 +358,82 @@ def write_json(output_path, json_data):
         json.dump(json_data, f, indent=4)
 
 
-def start_conversion_coco(raster_name, image_list, width, height, seg_list, description, categories_dict):
-    licenses_dict = write_licenses(name=raster_name)
-    info_dict = write_info(description=description)
-    images_dict, images_ids = write_images(image_list=image_list, width=width, height=height)
-    annotations_dict = write_annotations(label_list=seg_list, images_ids=images_ids, is_crowd=False,
-                                         categories=categories_dict)
-    categories_dict = write_categories(categories_list=list(categories_dict.keys()))
-
-    annotations_dict = {
-        **licenses_dict,
-        **info_dict,
-        **images_dict,
-        **annotations_dict,
-        **categories_dict,
+def dump_coco_element(json_data, compact, level=1):
+    if compact:
+        return json.dumps(json_data, separators=(",", ":"))
+
+    return indent(json.dumps(json_data, indent=4), " " * 4 * level).lstrip()
+
+
+def open_coco_stream(output_path, raster_name, description, categories_dict, compact=False, compress=False):
+    if compress:
+        output_path += '.gz'
+        coco_file = gzip.open(output_path, "wt")
+    else:
+        coco_file = open(output_path, "w")
+
+    coco_stream = {"file": coco_file, "output_path": output_path, "compact": compact, "images": [],
+                   "image_id": 1, "annotation_id": 1}
+
+    header_dict = {
+        **write_licenses(name=raster_name),
+        **write_info(description=description),
+        **write_categories(categories_list=list(categories_dict.keys())),
     }
 
-    return annotations_dict
+    separator = "" if compact else "\n    "
+
+    coco_file.write("{")
+
+    for key, value in header_dict.items():
+        coco_file.write(f'{separator}"{key}":{"" if compact else " "}{dump_coco_element(value, compact)},')
+
+    # annotations are written as tiles finish, the small image list is kept and written at the end
+    coco_file.write(f'{separator}"annotations":{"" if compact else " "}[')
+
+    return coco_stream
+
+
+@profile_stage(stage_name="coco_write")
+def write_coco_stream_tile(coco_stream, file_name, width, height, annotations):
+    image_id = coco_stream["image_id"]
+    coco_stream["image_id"] += 1
+
+    coco_stream["images"].append({"id": image_id, "width": width, "height": height, "file_name": file_name})
+
+    separator = "" if coco_stream["compact"] else "\n        "
+
+    for annotation in annotations:
+        annotation["image_id"] = image_id
+        annotation["id"] = coco_stream["annotation_id"]
+
+        if coco_stream["annotation_id"] > 1:
+            coco_stream["file"].write(",")
+
+        coco_stream["file"].write(separator + dump_coco_element(annotation, coco_stream["compact"], level=2))
+        coco_stream["annotation_id"] += 1
+
+    return image_id
+
+
+def close_coco_stream(coco_stream):
+    compact = coco_stream["compact"]
+    coco_file = coco_stream["file"]
+
+    element_separator = "," if compact else ",\n        "
+    images = element_separator.join(dump_coco_element(image, compact, level=2) for image in coco_stream["images"])
+
+    if compact:
+        coco_file.write(f'],"images":[{images}]}}')
+    else:
+        if coco_stream["annotation_id"] > 1:
+            coco_file.write("\n    ")
+
+        coco_file.write(f'],\n    "images": [\n        {images}\n    ]\n}}' if images else '],\n    "images": []\n}')
+
+    coco_file.close()
+
+    return coco_stream["output_path"]
 
 
 def check_categories(categories):
@@ -230,7 +459,9 @@ def draw_coco_labels(annotations_dict, annotations_image_path, drawn_annotations
 
     for image in annotations_dict["images"]:
         image_path = os.path.join(annotations_image_path, image["file_name"])
-        image_data = Image.open(image_path)
+        # sharded runs keep the images inside tar shards, file_name is relative to the shard directory
+        image_data = Image.open(BytesIO(read_shard_file(file_path=image_path)) if is_shard_path(file_path=image_path)
+                                else image_path)
 
         annotations = annotations_by_image.get(image["id"], [])
 
@@ -259,7 +490,8 @@ def draw_coco_labels(annotations_dict, annotations_image_path, drawn_annotations
 
         merged_image = Image.blend(image_data, draw_image, alpha=0.5)
 
-        labeled_image_path = os.path.join(drawn_annotations_path, image["file_name"].split('.')[0] + '.png')
+        labeled_image_path = os.path.join(drawn_annotations_path,
+                                          os.path.split(image["file_name"])[1].split('.')[0] + '.png')
         merged_image.save(labeled_image_path)
 
 
@@ -3,30 +3,38 @@ Author: Resul Emre AYGAN
 """
 
 import geopandas as gpd
+import numpy as np
 from osgeo.gdal import __version__ as osgeo_version
 from osgeo.ogr import GetDriverByName, wkbPolygon, Feature, CreateGeometryFromWkt, wkbMultiPolygon, Layer, Geometry
 from osgeo.osr import OAMS_TRADITIONAL_GIS_ORDER, SpatialReference, CoordinateTransformation
-from shapely import wkt
+from shapely import wkt, STRtree, intersection, area, transform, is_valid, is_missing, make_valid, get_parts, \
+    get_type_id, union_all
 from shapely.geometry import Polygon, MultiPolygon
 
+from utils.metric_operations import profile_stage, add_counter
+
 shape_driver = GetDriverByName("ESRI Shapefile")
 
 if shape_driver is None:
     raise ValueError("Can't find ESRI Shapefile Driver")
 
+vector_indexes = {}
+epsg_codes = {}
 
-def lon_lat_to_geom(lon, lat):
-    geom_str = "POLYGON (("
-    for index in range(len(lon)):
-        geom_str += str(lon[index]) + " " + str(lat[index]) + ","
-    geom_str += str(lon[0]) + " " + str(lat[0]) + " ))"
 
-    return wkt.loads(geom_str)
+def lon_lat_to_geom(lon, lat):
+    # same ring as the old WKT round trip, without formatting and parsing a string
+    return Polygon(zip(lon, lat))
 
 
 def check_epsg(projection):
-    utm_sr = SpatialReference(wkt=projection)
-    epsg = int(utm_sr.GetAttrValue('AUTHORITY', 1))
+    # every tile of a scene has the same projection, so the SpatialReference is only built once per WKT
+    epsg = epsg_codes.get(projection)
+
+    if epsg is None:
+        utm_sr = SpatialReference(wkt=projection)
+        epsg = int(utm_sr.GetAttrValue('AUTHORITY', 1))
+        epsg_codes[projection] = epsg
 
     return epsg
 
@@ -133,8 +141,61 @@ def read_shapefile_with_gpd(shapefile_path):
     return gpd.read_file(shapefile_path)
 
 
+def make_polygons_valid(geometries):
+    # a self-intersecting footprint fails every intersection with it, it is fixed once instead of in every tile
+    geometries = np.array(geometries, dtype=object)
+    invalid_indexes = np.flatnonzero(~is_valid(geometries) & ~is_missing(geometries))
+
+    for invalid_index, valid_geometry in zip(invalid_indexes, make_valid(geometries[invalid_indexes])):
+        # make_valid can leave collapsed parts as lines, only the polygons are kept
+        parts = get_parts(valid_geometry)
+        geometries[invalid_index] = union_all(parts[np.isin(get_type_id(parts), (3, 6))])
+
+    return geometries
+
+
+def get_vector_index(shapefile_path):
+    # forked tile workers inherit the loaded layer, spawned ones load it once
+    vector_index = vector_indexes.get(shapefile_path)
+
+    if vector_index is None:
+        vector_data = read_shapefile_with_gpd(shapefile_path=shapefile_path)
+        vector_data.geometry = make_polygons_valid(geometries=vector_data.geometry.values)
+        vector_index = (vector_data, STRtree(vector_data.geometry.values))
+        vector_indexes[shapefile_path] = vector_index
+
+    return vector_index
+
+
+@profile_stage(stage_name="clip")
+def clip_gdf_with_polygon(gdf_data, spatial_index, polygon):
+    feature_indexes = np.sort(spatial_index.query(polygon, predicate='intersects'))
+
+    clipped_data = gdf_data.iloc[feature_indexes].copy()
+    clipped_data.geometry = intersection(clipped_data.geometry.values, polygon)
+    clipped_data = clipped_data[area(clipped_data.geometry.values) > 0]
+
+    add_counter(counter_name="features_clipped", value=len(clipped_data))
+
+    return clipped_data
+
+
+def geometries_to_pixel(geometries, geo_transform):
+    # inverse of the geotransform, (x, y) -> (col, row) with pixel corners on integer coordinates
+    determinant = geo_transform[1] * geo_transform[5] - geo_transform[2] * geo_transform[4]
+
+    def world_to_pixel(coords):
+        delta_x = coords[:, 0] - geo_transform[0]
+        delta_y = coords[:, 1] - geo_transform[3]
+
+        return np.column_stack([(geo_transform[5] * delta_x - geo_transform[2] * delta_y) / determinant,
+                                (geo_transform[1] * delta_y - geo_transform[4] * delta_x) / determinant])
+
+    return transform(np.asarray(geometries), world_to_pixel)
+
+
 def get_categories_from_shapefile(shapefile_path):
-    vector_data = read_shapefile_with_gpd(shapefile_path=shapefile_path)
+    vector_data, _ = get_vector_index(shapefile_path=shapefile_path)
 
     if 'damage_gra' in vector_data.keys():
         return list(vector_data['damage_gra'].unique())
@@ -142,9 +203,10 @@ def get_categories_from_shapefile(shapefile_path):
         return []
 
 
-def save_gdf_to_shapefile(output_path, epsg, gdf_data):
+@profile_stage(stage_name="shapefile_write")
+def save_gdf_to_shapefile(output_path, epsg, gdf_data, allow_empty=False):
     try:
-        if not gdf_data.empty:
+        if not gdf_data.empty or allow_empty:
             gdf_data.to_file(output_path, driver='ESRI Shapefile', crs='EPSG:' + str(epsg))
             return True
         else:
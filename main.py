@@ -3,263 +3,236 @@ Author: Resul Emre AYGAN
 """
 
 from datetime import datetime
-from math import ceil
-from sys import exit
-
-from coco_operations import start_conversion_coco, check_categories, model_class
-from geometry_operations import bounds_to_polygon, transform_polygon_osr, create_shapefile, \
-    clip_shapefile_with_shapefile, get_categories_from_shapefile, read_shapefile_with_gpd, save_gdf_to_shapefile
-from raster_operations import crop_raster_with_warp, crop_raster_with_translate, change_raster_projection, \
-    vector_rasterization, get_array_from_raster, save_raster_as_png
-from utils.file_operations import write_json, delete_file, file_exists, get_file_name, generate_temp_file_path
+from sys import argv
+from time import perf_counter
+
+from coco_operations import check_categories, open_coco_stream, write_coco_stream_tile, close_coco_stream, \
+    deduplicate_tile_annotations
+from geometry_operations import get_categories_from_shapefile
+from raster_operations import close_rasters, create_mosaic_cog
+from tile_operations import prepare_scene_tile_jobs, run_tile_jobs, append_tile_manifest, load_tile_manifest, \
+    load_manifest_tile, run_tile_pipeline, get_tile_geo_transform
+from utils.file_operations import write_json, delete_file, file_exists, get_file_name, generate_temp_file_path, \
+    get_relative_path
 from utils.load_params import load_config
+from utils.metric_operations import set_profile_stages, merge_metrics, get_metrics_report, dump_stage_profiles
+from utils.shard_operations import open_shard_writer, write_shard_tile, close_shard_writer, close_shard_files
 
-if __name__ == '__main__':
-    print(f'Islem basladi - {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
-
-    [save_as_png, output_dir, crop_size_x, crop_size_y, crop_shape, shape_path, raster_format, raster_path,
-     seg_mask, seg_mask_as_png, convert_coco, _visualize_coco, _annotations_path,
-     _annotations_image_path, _drawn_annotations_path, _calculate_annotations_analysis] = load_config()
-    use_warp = False
-
-    unique_categories = get_categories_from_shapefile(shapefile_path=shape_path)
-    categories_dict = check_categories(categories=unique_categories)
-
-    if not file_exists(file_path=raster_path):
-        print(f"Raster bulunamadi! - {raster_path}")
-        exit()
+def write_deduplicated_tiles(coco_streams, coco_tiles):
+    for coco_tile, annotations in zip(coco_tiles, deduplicate_tile_annotations(coco_tiles=coco_tiles)):
+        # buildings are picked on the base level, the other levels keep the same copies through source_id
+        kept_sources = {annotation.get("source_id") for annotation in annotations}
 
-    raster_name = get_file_name(file_path=raster_path)
-    raster_path_4326 = generate_temp_file_path(output_path=output_dir, file_ext='tif')
-    annotations_path = generate_temp_file_path(output_path=output_dir,
-                                               file_ext='json',
-                                               file_name=raster_name.split('.')[0] + '_annotations')
-
-    [geo_transform, x_min, y_max, res_x, res_y, width, height, epsg, geom_poly] = get_array_from_raster(
-        file_path=raster_path)
-    #
-    # crop_size_x = min(width, crop_size_x)
-    # crop_size_y = min(height, crop_size_x)
+        for pyramid_level, coco_stream in coco_streams.items():
+            level_tile = coco_tile["level_tiles"][pyramid_level]
+            level_annotations = annotations if pyramid_level == 1 else [
+                annotation for annotation in level_tile["annotations"] if annotation["source_id"] in kept_sources]
 
-    generate_alpha = False
+            write_coco_stream_tile(coco_stream=coco_stream, file_name=level_tile["file_name"],
+                                   width=level_tile["width"], height=level_tile["height"],
+                                   annotations=level_annotations)
 
-    if epsg != 4326:
-        print(f"Raster EPSG:4326 formatinda degil, donusturuluyor. - {raster_path}")
-        generate_alpha = True
 
-        if not change_raster_projection(raster_path=raster_path, output_path=raster_path_4326, src_epsg=epsg,
-                                        dst_epsg=4326):
-            exit()
+if __name__ == '__main__':
+    print(f'Islem basladi - {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
 
-        [geo_transform, x_min, y_max, res_x, res_y, width, height, epsg, geom_poly] = get_array_from_raster(
-            file_path=raster_path_4326)
-        raster_path = raster_path_4326
+    start_time = perf_counter()
 
-    x_not_round = width / crop_size_x
-    x_round = ceil(x_not_round)
-    y_not_round = height / crop_size_y
-    y_round = ceil(y_not_round)
+    resume = '--resume' in argv
 
-    pix_to_mx = crop_size_x * x_round * res_x
-    pix_to_my = crop_size_y * y_round * abs(res_y)
+    config = load_config()
+    output_dir = config["output_dir"]
+    raster_paths = config["raster_paths"]
+    shape_path = config["shape_path"]
+    crop_shape = config["crop_shape"]
+    convert_coco = config["convert_coco"]
+    pyramid_levels = config["pyramid_levels"]
+    num_workers = config["num_workers"]
+    use_warp = False
 
-    x_size = pix_to_mx / x_round
-    y_size = pix_to_my / y_round
+    set_profile_stages(stage_names=config["profile_stages"])
 
-    x_steps = [x_min + x_size * i for i in range(x_round + 1)]
-    y_steps = [y_max - y_size * i for i in range(y_round + 1)]
+    # the vector layer and the category table are loaded once for every scene of the run
+    unique_categories = get_categories_from_shapefile(shapefile_path=shape_path)
+    categories_dict = check_categories(categories=unique_categories)
 
     if crop_shape:
         if not file_exists(file_path=shape_path):
             print(f"Shapefile bulunamadi! - {shape_path}")
             crop_shape = False
 
-    image_list = []
-    seg_list = []
-    categories_seg_list = []
-
-    for i in range(x_round):
-        for j in range(y_round):
-            temp_x_min = x_steps[i]
-            temp_x_max = x_steps[i + 1]
-            temp_y_max = y_steps[j]
-            temp_y_min = y_steps[j + 1]
+    if len(raster_paths) == 1:
+        raster_name = get_file_name(file_path=raster_paths[0])
+    else:
+        raster_name = 'batch'
 
-            temp_file_name = str("01") + "-" + str(j) + "-" + str(i)
-            temp_output_path = generate_temp_file_path(output_path=output_dir, file_name=temp_file_name, file_ext='tif')
-            temp_output_path_png = generate_temp_file_path(output_path=output_dir,
-                                                           file_name=temp_file_name,
-                                                           file_ext='png')
+    annotations_path = generate_temp_file_path(output_path=output_dir,
+                                               file_ext='json',
+                                               file_name=raster_name.split('.')[0] + '_annotations')
 
-            temp_bounds = (abs(temp_x_min), abs(temp_y_max), abs(temp_x_max), abs(temp_y_min))
+    tile_jobs = []
+    temp_raster_paths = []
+    skipped_counts = {"empty": 0, "without_features": 0}
+
+    for scene_index, raster_path in enumerate(raster_paths, start=1):
+        scene = prepare_scene_tile_jobs(scene_index=scene_index, raster_path=raster_path, output_dir=output_dir,
+                                        crop_size_x=config["crop_size_x"], crop_size_y=config["crop_size_y"],
+                                        virtual_reprojection=config["virtual_reprojection"],
+                                        skip_empty_tiles=config["skip_empty_tiles"],
+                                        skip_tiles_without_features=config["skip_tiles_without_features"],
+                                        tile_overlap=config["tile_overlap"], tile_edge_mode=config["tile_edge_mode"],
+                                        raster_format=config["raster_format"], use_warp=use_warp,
+                                        window_read=config["window_read"], save_tile_raster=config["save_tile_raster"],
+                                        save_as_png=config["save_as_png"], crop_shape=crop_shape,
+                                        shape_path=shape_path, seg_mask=config["seg_mask"],
+                                        seg_mask_as_png=config["seg_mask_as_png"], convert_coco=convert_coco,
+                                        categories_dict=categories_dict, png_backend=config["png_backend"],
+                                        png_compression=config["png_compression"],
+                                        annotation_engine=config["annotation_engine"],
+                                        raster_profile=config["raster_profile"],
+                                        raster_compression=config["raster_compression"],
+                                        pyramid_levels=pyramid_levels)
+
+        if config["mosaic_cog"] and scene["mosaic"] is not None:
+            mosaic_name = f'{scene_index:02d}_{get_file_name(file_path=raster_path)}_mosaic'
+            mosaic_path = generate_temp_file_path(output_path=output_dir, file_ext='tif', file_name=mosaic_name)
+
+            if create_mosaic_cog(output_path=mosaic_path, raster_compression=config["raster_compression"],
+                                 **scene["mosaic"]):
+                print(f'Mozaik COG yazildi. {mosaic_path} - {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
+
+        tile_jobs.extend(scene["tile_jobs"])
+
+        for key, count in scene["skipped_counts"].items():
+            skipped_counts[key] += count
+
+        if scene["temp_raster_path"] is not None:
+            temp_raster_paths.append(scene["temp_raster_path"])
+
+    if not tile_jobs:
+        print(f"Islenecek parca bulunamadi! - {raster_paths}")
+
+    manifest_path = generate_temp_file_path(output_path=output_dir,
+                                            file_ext='jsonl',
+                                            file_name=raster_name.split('.')[0] + '_manifest')
+
+    if resume:
+        # tiles finished with other pyramid levels are processed again
+        completed_tiles = {tile_name: manifest_tile for tile_name, manifest_tile
+                           in load_tile_manifest(manifest_path=manifest_path).items()
+                           if sorted(map(int, manifest_tile["levels"])) == pyramid_levels[1:]}
+    else:
+        delete_file(file_path=manifest_path)
+        completed_tiles = {}
+
+    pending_jobs = [tile_job for tile_job in tile_jobs if tile_job["temp_file_name"] not in completed_tiles]
+
+    print(f'{len(tile_jobs)} adet parcadan {len(tile_jobs) - len(pending_jobs)} tanesi daha once tamamlanmis, '
+          f'{len(pending_jobs)} adet parca {num_workers} islemci ile isleniyor - '
+          f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
+
+    shard_writer = None
+
+    if config["shard_output"]:
+        shard_writer = open_shard_writer(output_dir=output_dir, shard_prefix=raster_name.split('.')[0],
+                                         shard_size=config["shard_size"], resume=resume)
+
+    # every pyramid level gets its own COCO file, the base level keeps the usual name
+    coco_streams = {}
 
-            if use_warp:
-                temp_polygon = bounds_to_polygon(geom_bounds=temp_bounds)
-                transformed_poly = transform_polygon_osr(polygon=temp_polygon, src_epsg=epsg, dst_epsg=4326)
-                temp_bounds = transformed_poly.bounds
+    if convert_coco:
+        categories_path = generate_temp_file_path(output_path=output_dir, file_name='categories', file_ext='json')
+        write_json(output_path=categories_path, json_data=categories_dict)
 
-                _ = crop_raster_with_warp(raster_path=raster_path, output_bounds=temp_bounds,
-                                          output_path=temp_output_path, epsg_number=4326, multi=True, num_thread=-9999)
+        for pyramid_level in pyramid_levels:
+            level_annotations_path = annotations_path if pyramid_level == 1 else generate_temp_file_path(
+                output_path=output_dir, file_ext='json',
+                file_name=raster_name.split('.')[0] + f'_x{pyramid_level}_annotations')
+
+            coco_streams[pyramid_level] = open_coco_stream(output_path=level_annotations_path, raster_name=raster_name,
+                                                           description="pre_annotation_sample",
+                                                           categories_dict=categories_dict,
+                                                           compact=config["coco_compact"], compress=config["coco_gzip"])
+
+    # overlapping tiles hold the same buildings, their annotations are kept until every tile of the scene is known
+    deduplicate = bool(coco_streams) and config["deduplicate_annotations"] and config["tile_overlap"] > 0
+    coco_tiles = []
+
+    if config["pipeline"]:
+        pending_results = run_tile_pipeline(tile_jobs=pending_jobs, prefetch_queue_size=config["prefetch_queue_size"],
+                                            encoder_workers=config["encoder_workers"],
+                                            write_queue_size=config["write_queue_size"])
+    else:
+        pending_results = run_tile_jobs(tile_jobs=pending_jobs, num_workers=num_workers)
+
+    # tiles are visited in grid order, finished ones come from the manifest so the COCO file is rebuilt in full
+    for tile_job in tile_jobs:
+        manifest_tile = completed_tiles.get(tile_job["temp_file_name"])
+
+        if manifest_tile is not None:
+            tile_result = load_manifest_tile(manifest_path=manifest_path, manifest_tile=manifest_tile)
+        else:
+            tile_result = next(pending_results)
+            merge_metrics(metrics=tile_result.pop("metrics", None))
+
+            # outputs are packed before the manifest line so a resumed run finds them inside the shards
+            if shard_writer is not None:
+                tile_result = write_shard_tile(shard_writer=shard_writer, tile_result=tile_result)
+
+            append_tile_manifest(manifest_path=manifest_path, tile_result=tile_result)
+
+        if coco_streams:
+            level_results = {1: tile_result, **{int(pyramid_level): level_result for pyramid_level, level_result
+                                                in tile_result.get("levels", {}).items()}}
+            level_tiles = {pyramid_level: {"file_name": get_relative_path(file_path=level_result["image_list"][0],
+                                                                          dir_path=output_dir),
+                                           "width": level_result["width"], "height": level_result["height"],
+                                           "annotations": level_result["annotations"]}
+                           for pyramid_level, level_result in level_results.items()}
+
+            if deduplicate:
+                # tiles come scene by scene and only a scene's own tiles overlap, a finished scene is written out
+                if coco_tiles and coco_tiles[-1]["scene"] != tile_job["raster_path"]:
+                    write_deduplicated_tiles(coco_streams=coco_streams, coco_tiles=coco_tiles)
+                    coco_tiles = []
+
+                coco_tiles.append({**level_tiles[1], "scene": tile_job["raster_path"],
+                                   "geo_transform": get_tile_geo_transform(tile_job=tile_job),
+                                   "level_tiles": level_tiles})
             else:
-                crop_raster_with_translate(raster_path=raster_path, output_path=temp_output_path,
-                                           res_x=res_x, res_y=res_y, output_bounds=temp_bounds,
-                                           raster_format=raster_format)
+                for pyramid_level, coco_stream in coco_streams.items():
+                    write_coco_stream_tile(coco_stream=coco_stream, **level_tiles[pyramid_level])
 
-            [original_raster, alpha_channel, geo_transform, min_x, max_y, res_x, res_y, width, height,
-             epsg, geom_poly] = get_array_from_raster(file_path=temp_output_path, only_info=False)
+    if deduplicate:
+        write_deduplicated_tiles(coco_streams=coco_streams, coco_tiles=coco_tiles)
 
-            if save_as_png:
-                save_raster_as_png(raster_array=original_raster, alpha_channel=alpha_channel,
-                                   output_path=temp_output_path_png, generate_alpha=generate_alpha)
-                image_list.append(temp_output_path_png)
-            else:
-                image_list.append(temp_output_path)
-
-            if crop_shape:
-                temp_shape_path = generate_temp_file_path(output_path=output_dir,
-                                                          file_name=temp_file_name + "_tmp",
-                                                          file_ext='shp')
-                temp_shx_path = generate_temp_file_path(output_path=output_dir,
-                                                        file_name=temp_file_name + "_tmp",
-                                                        file_ext='shx')
-                temp_dbf_path = generate_temp_file_path(output_path=output_dir,
-                                                        file_name=temp_file_name + "_tmp",
-                                                        file_ext='dbf')
-                temp_prj_path = generate_temp_file_path(output_path=output_dir,
-                                                        file_name=temp_file_name + "_tmp",
-                                                        file_ext='prj')
-                temp_cfg_path = generate_temp_file_path(output_path=output_dir,
-                                                        file_name=temp_file_name + "_tmp",
-                                                        file_ext='cfg')
-                crop_shape_path = generate_temp_file_path(output_path=output_dir,
-                                                          file_name=temp_file_name,
-                                                          file_ext='shp')
-
-                if create_shapefile(geom_wkt=geom_poly.wkt, output_path=temp_shape_path, epsg=epsg):
-                    if not clip_shapefile_with_shapefile(input_shapefile=shape_path, clip_shapefile=temp_shape_path,
-                                                         output_shapefile=crop_shape_path):
-                        delete_file(file_path=crop_shape_path)
-
-                delete_file(file_path=temp_shape_path)
-                delete_file(file_path=temp_shx_path)
-                delete_file(file_path=temp_dbf_path)
-                delete_file(file_path=temp_prj_path)
-                delete_file(file_path=temp_cfg_path)
-
-                added_seg_list = False
-
-                if seg_mask:
-                    seg_mask_path = generate_temp_file_path(output_path=output_dir,
-                                                            file_name=temp_file_name + "_seg",
-                                                            file_ext='tif')
-
-                    temp_mask_bounds = (abs(temp_x_min), abs(temp_y_min), abs(temp_x_max), abs(temp_y_max))
-
-                    vector_rasterization(shape_path=crop_shape_path, output_bounds=temp_mask_bounds,
-                                         output_path=seg_mask_path, res_x=res_x, res_y=res_y)
-
-                    if not len(categories_dict) == 1 and 'buildings' in categories_dict.keys():
-                        data = read_shapefile_with_gpd(shapefile_path=crop_shape_path)
-
-                        if 'damage_gra' in data.keys():
-                            for damage_gra_val in data['damage_gra'].unique():
-                                uncertain_case = False
-
-                                if damage_gra_val not in model_class.keys():
-                                    file_val = model_class[""]
-                                else:
-                                    file_val = model_class[damage_gra_val]
-
-                                categories_shape_path = generate_temp_file_path(
-                                    output_path=output_dir, file_name=f'{temp_file_name}_{file_val}',
-                                    file_ext='shp')
-
-                                if "Possibly damaged" == damage_gra_val or "Damaged" == damage_gra_val:
-                                    if file_exists(file_path=categories_shape_path):
-                                        continue
-                                    else:
-                                        uncertain_case = True
-
-                                categories_mask_path = generate_temp_file_path(
-                                    output_path=output_dir, file_name=f'{temp_file_name}_{file_val}_seg',
-                                    file_ext='tif')
-                                categories_mask_png_path = generate_temp_file_path(
-                                    output_path=output_dir, file_name=f'{temp_file_name}_{file_val}_seg',
-                                    file_ext='png')
-
-                                print(f'Kategorinin shapefile dosyasi olusturuluyor. {categories_shape_path} - '
-                                      f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
-
-                                if uncertain_case:
-                                    filtered_data = data[(data['damage_gra'] == "Possibly damaged") |
-                                                         (data['damage_gra'] == "Damaged")]
-                                else:
-                                    filtered_data = data[data['damage_gra'] == damage_gra_val]
-
-                                if not save_gdf_to_shapefile(output_path=categories_shape_path, epsg=epsg,
-                                                             gdf_data=filtered_data):
-                                    continue
-
-                                print(f'Kategorinin segmentation mask dosyasi olusturuluyor. {categories_mask_path} - '
-                                      f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
-
-                                vector_rasterization(shape_path=categories_shape_path, output_bounds=temp_mask_bounds,
-                                                     output_path=categories_mask_path, res_x=res_x, res_y=res_y,
-                                                     burn_value=categories_dict[file_val]['rgb'])
-                                if seg_mask_as_png:
-                                    print(
-                                        f'Kategorinin segmentation png dosyasi olusturuluyor. '
-                                        f'{categories_mask_png_path} - '
-                                        f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
-                                    [_original_raster, _alpha_channel, _geo_transform, _min_x, _max_y, _res_x, _res_y,
-                                     _width, _height, _epsg, _geom_poly] = get_array_from_raster(
-                                        file_path=categories_mask_path, only_info=False)
-
-                                    save_raster_as_png(raster_array=_original_raster,
-                                                       output_path=categories_mask_png_path,
-                                                       generate_alpha=False)
-
-                                    categories_seg_list.append(categories_mask_png_path)
-                                    added_seg_list = True
-                                else:
-                                    categories_seg_list.append(categories_mask_path)
-                                    added_seg_list = True
-
-                    if seg_mask_as_png:
-                        seg_mask_png_path = generate_temp_file_path(output_path=output_dir,
-                                                                    file_name=temp_file_name + "_seg",
-                                                                    file_ext='png')
-                        print(f'Raster\'a ait tum segmantation png dosyasi olusturuluyor. {seg_mask_png_path} - '
-                              f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
-
-                        [_original_raster, _alpha_channel, _geo_transform, _min_x, _max_y, _res_x, _res_y, _width,
-                         _height,
-                         _epsg, _geom_poly] = get_array_from_raster(file_path=seg_mask_path, only_info=False)
-
-                        save_raster_as_png(raster_array=_original_raster, output_path=seg_mask_png_path,
-                                           generate_alpha=False)
-
-                        if not added_seg_list:
-                            seg_list.append(seg_mask_png_path)
-                    else:
-                        if not added_seg_list:
-                            seg_list.append(seg_mask_path)
-
-    ds = None
+    close_rasters()
+    close_shard_files()
 
-    if convert_coco:
-        categories_path = generate_temp_file_path(output_path=output_dir, file_name='categories', file_ext='json')
-        write_json(output_path=categories_path, json_data=categories_dict)
+    if shard_writer is not None:
+        close_shard_writer(shard_writer=shard_writer)
+
+    for coco_stream in coco_streams.values():
+        annotations_path = close_coco_stream(coco_stream=coco_stream)
+        print(f'COCO etiketleri yazildi. {annotations_path} - {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
+
+    for temp_raster_path in temp_raster_paths:
+        delete_file(file_path=temp_raster_path)
+
+    print(f'Atlanan parca sayisi - bos/nodata: {skipped_counts["empty"]}, '
+          f'vektor icermeyen: {skipped_counts["without_features"]}')
 
-        categories_seg_list.extend(seg_list)
-        label_list = list(set(categories_seg_list))
+    metrics_path = generate_temp_file_path(output_path=output_dir,
+                                           file_ext='json',
+                                           file_name=raster_name.split('.')[0] + '_metrics')
 
-        annotations_dict = start_conversion_coco(image_list=image_list, width=width, height=height, seg_list=label_list,
-                                                 raster_name=raster_name, description="pre_annotation_sample",
-                                                 categories_dict=categories_dict)
+    metrics_report = get_metrics_report(wall_seconds=perf_counter() - start_time)
+    metrics_report["counters"].update({f'skipped_{key}': count for key, count in skipped_counts.items()})
+    write_json(output_path=metrics_path, json_data=metrics_report)
 
-        write_json(output_path=annotations_path, json_data=annotations_dict)
+    print(f'Asama sureleri yazildi. {metrics_path} - {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
 
-    delete_file(file_path=raster_path_4326)
+    for profile_path in dump_stage_profiles(output_dir=output_dir):
+        print(f'Profil dosyasi yazildi. {profile_path}')
 
     print(f'Islem tamamlandi - {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
@@ -2,27 +2,112 @@
 Author: Resul Emre AYGAN
 """
 
-import matplotlib.pyplot as plt
+from collections import OrderedDict
+from io import BytesIO
+from math import ceil
+from os import getpid, stat
+from threading import get_ident, local, Lock
+
 import numpy as np
-from osgeo.gdal import Open, Translate, Warp, GDT_Byte, GDT_UInt16, GRA_Bilinear, Rasterize
+from PIL import Image
+from osgeo.gdal import Open, Translate, Warp, GDT_Byte, GDT_UInt16, GRA_Bilinear, Rasterize, GetDriverByName, \
+    GDT_UInt32, GCI_AlphaBand, DCAP_CREATE, GRIORA_Average, GRIORA_NearestNeighbour, VSIFOpenL, VSIFReadL, \
+    VSIFCloseL, VSIStatL, Unlink
+from osgeo.gdal_array import GDALTypeCodeToNumericTypeCode, OpenArray
+from osgeo.ogr import GetDriverByName as GetVectorDriverByName, Feature, FieldDefn, OFTInteger, wkbUnknown, \
+    CreateGeometryFromWkb
+from osgeo.osr import SpatialReference
 
 from geometry_operations import check_epsg, lon_lat_to_geom
+from utils.file_operations import write_bytes, file_exists, get_file_size
+from utils.metric_operations import profile_stage, add_counter
+
+# open handles and parsed metadata are kept per process, the least recently used ones are closed first
+raster_datasets = OrderedDict()
+raster_metadata = {}
+raster_lock = Lock()
+max_open_rasters = 32
+
+png_backends = ["pil", "gdal", "matplotlib"]
+
+raster_profiles = ["plain", "tiled", "cog"]
+raster_compressions = ["NONE", "DEFLATE", "ZSTD", "LZW"]
+
+byte_luts = {}
+# tile buffers reused by each thread, freed with the reader and encoder threads of a finished run
+thread_buffers = local()
+
+
+def get_raster_creation_options(raster_format, raster_profile="plain", raster_compression="NONE", block_size=512,
+                                overview_resampling="AVERAGE"):
+    # profiles only apply to GeoTIFF output, other drivers are written with their defaults
+    if raster_format.upper() not in ["GTIFF", "COG"]:
+        return raster_format, []
+
+    creation_options = [f'COMPRESS={raster_compression}']
 
+    if raster_profile == "cog" or raster_format.upper() == "COG":
+        # the COG driver always writes internal tiles and builds the overviews itself
+        creation_options.extend([f'BLOCKSIZE={block_size}', 'OVERVIEWS=AUTO', f'RESAMPLING={overview_resampling}'])
 
-def crop_raster_with_translate(raster_path, output_path, res_x, res_y, output_bounds, raster_format, raster_bit=8):
+        if raster_compression != "NONE":
+            creation_options.append('PREDICTOR=YES')
+
+        return 'COG', creation_options
+
+    if raster_compression != "NONE":
+        # horizontal differencing, neighbouring pixels of imagery and masks are mostly equal
+        creation_options.append('PREDICTOR=2')
+
+    if raster_profile == "tiled":
+        creation_options.extend(['TILED=YES', f'BLOCKXSIZE={block_size}', f'BLOCKYSIZE={block_size}'])
+
+    return 'GTiff', creation_options
+
+
+@profile_stage(stage_name="translate")
+def crop_raster_with_translate(raster_path, output_path, res_x, res_y, output_bounds, raster_format, raster_bit=8,
+                               raster_profile="plain", raster_compression="NONE"):
     try:
         if raster_bit == 16:
             raster_type = GDT_UInt16
         else:
             raster_type = GDT_Byte
 
+        raster_format, creation_options = get_raster_creation_options(raster_format=raster_format,
+                                                                      raster_profile=raster_profile,
+                                                                      raster_compression=raster_compression)
+
         _ = Translate(output_path, raster_path, projWin=output_bounds, xRes=res_x, yRes=-res_y,
-                      outputType=raster_type, format=raster_format)
+                      outputType=raster_type, format=raster_format, creationOptions=creation_options)
         _ = None
     except Exception as error:
         print(f"Raster kesme metotunda hata olustu: {error} - {raster_path}")
 
 
+@profile_stage(stage_name="mosaic")
+def create_mosaic_cog(raster_path, output_path, output_bounds, res_x, res_y, raster_compression="DEFLATE",
+                      block_size=512):
+    try:
+        _, creation_options = get_raster_creation_options(raster_format='COG', raster_profile="cog",
+                                                          raster_compression=raster_compression,
+                                                          block_size=block_size)
+
+        # a scene mosaic can pass the 4 GB limit of a classic tiff
+        _ = Translate(output_path, raster_path, projWin=output_bounds, xRes=res_x, yRes=-res_y,
+                      outputType=GDT_Byte, format='COG', creationOptions=creation_options + ['BIGTIFF=IF_SAFER'])
+        _ = None
+
+        if file_exists(file_path=output_path):
+            add_counter(counter_name="bytes_written", value=get_file_size(file_path=output_path))
+
+        return True
+    except Exception as error:
+        print(f"Mozaik COG olusturulurken hata olustu: {error} - {raster_path}")
+        return False
+
+
+@profile_stage(stage_name="warp")
 def crop_raster_with_warp(raster_path, shape_path=None, output_bounds=None, alpha_info=False, output_path=None,
                           width=0, height=0, cutline_bool=False, epsg_number=4326, multi=False, num_thread=1):
     try:
@@ -51,12 +136,15 @@ def crop_raster_with_warp(raster_path, shape_path=None, output_bounds=None, alph
         print(f"Raster kesme metotunda hata olustu: {error} - {raster_path}")
 
 
-def change_raster_projection(raster_path, output_path, src_epsg="EPSG:3857", dst_epsg="EPSG:4326", dst_alpha=True):
+@profile_stage(stage_name="reproject")
+def change_raster_projection(raster_path, output_path, src_epsg="EPSG:3857", dst_epsg="EPSG:4326", dst_alpha=True,
+                             output_format="GTiff"):
     try:
         src_epsg = "EPSG:" + str(src_epsg)
         dst_epsg = "EPSG:" + str(dst_epsg)
 
-        _ = Warp(output_path, raster_path, srcSRS=src_epsg, dstSRS=dst_epsg, dstAlpha=dst_alpha)
+        # with output_format="VRT" only the warp definition is written, pixels are resampled when they are read
+        _ = Warp(output_path, raster_path, srcSRS=src_epsg, dstSRS=dst_epsg, dstAlpha=dst_alpha, format=output_format)
         _ = None
 
         return True
@@ -84,19 +172,107 @@ def vector_rasterization(shape_path, output_path, output_bounds, res_x, res_y, b
         return False
 
 
-def get_array_from_raster(file_path, only_info=True):
-    raster_ds = Open(file_path)
+@profile_stage(stage_name="rasterize")
+def rasterize_geometries(geometries, burn_values, geo_transform, width, height, epsg=4326, output_bit=GDT_Byte):
+    try:
+        srs = SpatialReference()
+        srs.ImportFromEPSG(epsg)
+
+        raster_ds = GetDriverByName('MEM').Create('', width, height, 1, output_bit)
+        raster_ds.SetGeoTransform(geo_transform)
+        raster_ds.SetProjection(srs.ExportToWkt())
+
+        if len(geometries) > 0:
+            vector_ds = GetVectorDriverByName('Memory').CreateDataSource('')
+            layer = vector_ds.CreateLayer('geometries', srs, wkbUnknown)
+            layer.CreateField(FieldDefn('burn_value', OFTInteger))
 
-    if raster_ds is None:
-        raise IOError(f'Tif dosyasi acilamadi! {file_path}')
+            for geometry, burn_value in zip(geometries, burn_values):
+                feature = Feature(layer.GetLayerDefn())
+                feature.SetGeometry(CreateGeometryFromWkb(geometry.wkb))
+                feature.SetField('burn_value', int(burn_value))
+                layer.CreateFeature(feature)
+                feature = None
 
-    band_number = raster_ds.RasterCount
-    projection = raster_ds.GetProjection()
-    geo_transform = raster_ds.GetGeoTransform()
+            _ = Rasterize(raster_ds, vector_ds, attribute='burn_value')
+            _ = None
+            vector_ds = None
 
-    width = raster_ds.RasterXSize
-    height = raster_ds.RasterYSize
+        label_array = raster_ds.GetRasterBand(1).ReadAsArray()
+        raster_ds = None
 
+        return label_array
+    except Exception as error:
+        print(f"Vektorden raster uretilirken hata olustu: {error}")
+        return None
+
+
+def rasterize_instances(geometries, geo_transform, width, height, epsg=4326):
+    # every geometry is burnt with its own 1 based index, 0 stays background
+    return rasterize_geometries(geometries=geometries, burn_values=range(1, len(geometries) + 1),
+                                geo_transform=geo_transform, width=width, height=height, epsg=epsg,
+                                output_bit=GDT_UInt32)
+
+
+def label_to_rgb_mask(label_array, label_value, rgb):
+    rgb_mask = np.zeros(label_array.shape + (3,), dtype=np.uint8)
+    rgb_mask[label_array == label_value] = rgb
+
+    return rgb_mask
+
+
+def get_raster_band_list(band_number):
+    if band_number > 2:
+        raster_bands = [1, 2, 3]
+    else:
+        raster_bands = [1]
+
+    # the last band is read as alpha for RGBA and gray + alpha rasters
+    if band_number > 3 or band_number == 2:
+        raster_bands.append(band_number)
+
+    return raster_bands
+
+
+def read_raster_bands(raster_ds, band_list, x_off, y_off, width, height, raster_buffer,
+                      resample_alg=GRIORA_NearestNeighbour):
+    # one pixel-interleaved call fills the HWC buffer, GDAL converts the data type into the buffer's type and
+    # resamples the window when the buffer is smaller than it
+    if len(band_list) == 1:
+        raster_ds.ReadAsArray(x_off, y_off, width, height, buf_obj=raster_buffer[:, :, 0], band_list=band_list,
+                              resample_alg=resample_alg)
+    else:
+        raster_ds.ReadAsArray(x_off, y_off, width, height, buf_obj=raster_buffer, band_list=band_list,
+                              interleave='pixel', resample_alg=resample_alg)
+
+    return raster_buffer
+
+
+def get_raster_buffer(height, width, band_count, dtype, raster_buffer=None):
+    if raster_buffer is not None and raster_buffer.shape == (height, width, band_count) and \
+            raster_buffer.dtype == dtype:
+        return raster_buffer
+
+    return np.empty((height, width, band_count), dtype=dtype)
+
+
+def get_read_array(height, width, band_count):
+    # one read buffer per thread, only for callers that are done with the previous tile before reading the next
+    read_array = get_raster_buffer(height=height, width=width, band_count=band_count, dtype=np.uint8,
+                                   raster_buffer=getattr(thread_buffers, "read_array", None))
+    thread_buffers.read_array = read_array
+
+    return read_array
+
+
+def split_raster_buffer(raster_buffer, band_number):
+    if band_number > 3 or band_number == 2:
+        return raster_buffer[:, :, :-1], raster_buffer[:, :, -1]
+
+    return raster_buffer, None
+
+
+def get_raster_info(geo_transform, width, height, epsg):
     min_x = geo_transform[0]
     min_y = geo_transform[3] + width * geo_transform[4] + height * geo_transform[5]
     max_x = geo_transform[0] + width * geo_transform[1] + height * geo_transform[2]
@@ -108,64 +284,512 @@ def get_array_from_raster(file_path, only_info=True):
     lon = [min_x, max_x, max_x, min_x]  # [ulx, lrx, lrx, ulx]
     lat = [max_y, max_y, min_y, min_y]  # [uly, uly, lry, lry]
 
-    epsg = check_epsg(projection=projection)
-
     geom_poly = lon_lat_to_geom(lon=lon, lat=lat)
 
+    return geo_transform, min_x, max_y, res_x, res_y, width, height, epsg, geom_poly
+
+
+@profile_stage(stage_name="raster_read")
+def get_array_from_raster(file_path, only_info=True, window=None, raster_buffer=None):
+    metadata = get_raster_metadata(file_path=file_path)
+
+    band_number = metadata["band_number"]
+
+    if window is None:
+        x_off, y_off = 0, 0
+        [geo_transform, min_x, max_y, res_x, res_y, width, height, epsg, geom_poly] = metadata["info"]
+    else:
+        x_off, y_off, width, height = window
+        src_geo_transform = metadata["geo_transform"]
+
+        geo_transform = (src_geo_transform[0] + x_off * src_geo_transform[1] + y_off * src_geo_transform[2],
+                         src_geo_transform[1], src_geo_transform[2],
+                         src_geo_transform[3] + x_off * src_geo_transform[4] + y_off * src_geo_transform[5],
+                         src_geo_transform[4], src_geo_transform[5])
+
+        [geo_transform, min_x, max_y, res_x, res_y, width, height, epsg,
+         geom_poly] = get_raster_info(geo_transform=geo_transform, width=width, height=height, epsg=metadata["epsg"])
+
     alpha_channel = None
 
     if not only_info:
-        if band_number > 2:
-            original_raster = np.dstack([raster_ds.GetRasterBand(1).ReadAsArray(),
-                                         raster_ds.GetRasterBand(2).ReadAsArray(),
-                                         raster_ds.GetRasterBand(3).ReadAsArray()])
-            if band_number > 3:
-                alpha_channel = raster_ds.GetRasterBand(raster_ds.RasterCount).ReadAsArray().astype(np.uint8)
-        else:
-            original_raster = np.dstack([raster_ds.GetRasterBand(1).ReadAsArray()])
+        raster_ds = open_raster(file_path=file_path)
+
+        raster_bands = get_raster_band_list(band_number=band_number)
+        dtype = GDALTypeCodeToNumericTypeCode(metadata["data_type"])
+
+        raster_buffer = get_raster_buffer(height=height, width=width, band_count=len(raster_bands), dtype=dtype,
+                                          raster_buffer=raster_buffer)
+        read_raster_bands(raster_ds=raster_ds, band_list=raster_bands, x_off=x_off, y_off=y_off, width=width,
+                          height=height, raster_buffer=raster_buffer)
 
-            if band_number == 2:
-                alpha_channel = raster_ds.GetRasterBand(raster_ds.RasterCount).ReadAsArray().astype(np.uint8)
+        original_raster, alpha_channel = split_raster_buffer(raster_buffer=raster_buffer, band_number=band_number)
 
-        temp_ds = None
+        if alpha_channel is not None:
+            alpha_channel = array_to_byte(raster_array=alpha_channel)
+
+        add_counter(counter_name="bytes_read", value=raster_buffer.nbytes)
 
         return original_raster, alpha_channel, geo_transform, min_x, max_y, res_x, res_y, width, height, epsg, geom_poly
     else:
-        temp_ds = None
-
         return geo_transform, min_x, max_y, res_x, res_y, width, height, epsg, geom_poly
 
 
-def normalize_byte(raster_array):
+def open_raster(file_path):
+    # GDAL handles must not be shared between the processes of the tile pool
+    dataset_key = (getpid(), file_path)
+
+    with raster_lock:
+        raster_ds = raster_datasets.get(dataset_key)
+
+        if raster_ds is not None:
+            raster_datasets.move_to_end(dataset_key)
+            return raster_ds
+
+        raster_ds = Open(file_path)
+
+        if raster_ds is None:
+            raise IOError(f'Tif dosyasi acilamadi! {file_path}')
+
+        # metadata can outlive a handle (forked workers, closed temp tiles), it is checked once per new handle
+        metadata = raster_metadata.get(file_path)
+
+        if metadata is not None and metadata["signature"] != get_file_signature(file_path=file_path):
+            del raster_metadata[file_path]
+
+        raster_datasets[dataset_key] = raster_ds
+
+        while len(raster_datasets) > max_open_rasters:
+            (_, evicted_path), _ = raster_datasets.popitem(last=False)
+            raster_metadata.pop(evicted_path, None)
+
+    return raster_ds
+
+
+def get_file_signature(file_path):
+    try:
+        file_stat = stat(file_path)
+    except OSError:
+        # GDAL virtual paths (/vsimem, /vsizip, ...) can not be checked on disk
+        return None
+
+    return file_stat.st_mtime_ns, file_stat.st_size
+
+
+def get_raster_metadata(file_path):
+    raster_ds = open_raster(file_path=file_path)
+
+    with raster_lock:
+        metadata = raster_metadata.get(file_path)
+
+        if metadata is not None:
+            return metadata
+
+        geo_transform = raster_ds.GetGeoTransform()
+        width = raster_ds.RasterXSize
+        height = raster_ds.RasterYSize
+        epsg = check_epsg(projection=raster_ds.GetProjection())
+
+        metadata = {"signature": get_file_signature(file_path=file_path), "band_number": raster_ds.RasterCount,
+                    "data_type": raster_ds.GetRasterBand(1).DataType, "geo_transform": geo_transform,
+                    "width": width, "height": height, "epsg": epsg,
+                    "overview_count": raster_ds.GetRasterBand(1).GetOverviewCount(),
+                    "info": get_raster_info(geo_transform=geo_transform, width=width, height=height, epsg=epsg)}
+
+        raster_metadata[file_path] = metadata
+
+    return metadata
+
+
+def close_raster(file_path):
+    with raster_lock:
+        raster_datasets.pop((getpid(), file_path), None)
+        raster_metadata.pop(file_path, None)
+
+
+def close_rasters():
+    with raster_lock:
+        raster_datasets.clear()
+        raster_metadata.clear()
+
+
+def array_to_byte(raster_array):
+    # same clamping as Translate(outputType=GDT_Byte) without scaling
+    if raster_array.dtype == np.uint8:
+        return raster_array
+
+    if np.issubdtype(raster_array.dtype, np.floating):
+        raster_array = np.rint(raster_array)
+
+    return np.clip(raster_array, 0, 255).astype(np.uint8)
+
+
+def bounds_to_window(geo_transform, output_bounds):
+    ul_x, ul_y, lr_x, lr_y = output_bounds
+
+    x_off = int(round((ul_x - geo_transform[0]) / geo_transform[1]))
+    y_off = int(round((ul_y - geo_transform[3]) / geo_transform[5]))
+    width = int(round((lr_x - ul_x) / geo_transform[1]))
+    height = int(round((lr_y - ul_y) / geo_transform[5]))
+
+    return x_off, y_off, width, height
+
+
+def clip_window(raster_ds, x_off, y_off, width, height):
+    read_x_min = max(x_off, 0)
+    read_y_min = max(y_off, 0)
+    read_x_max = min(x_off + width, raster_ds.RasterXSize)
+    read_y_max = min(y_off + height, raster_ds.RasterYSize)
+
+    return read_x_min, read_y_min, read_x_max, read_y_max
+
+
+@profile_stage(stage_name="empty_check")
+def is_raster_window_empty(file_path, output_bounds, sample_factor=16):
+    metadata = get_raster_metadata(file_path=file_path)
+    raster_ds = open_raster(file_path=file_path)
+
+    band_number = metadata["band_number"]
+
+    x_off, y_off, width, height = bounds_to_window(geo_transform=metadata["geo_transform"],
+                                                   output_bounds=output_bounds)
+    read_x_min, read_y_min, read_x_max, read_y_max = clip_window(raster_ds=raster_ds, x_off=x_off, y_off=y_off,
+                                                                 width=width, height=height)
+
+    if read_x_max <= read_x_min or read_y_max <= read_y_min:
+        return True
+
+    read_width = read_x_max - read_x_min
+    read_height = read_y_max - read_y_min
+
+    # a reduced buffer lets GDAL answer from overviews, a block only averages to nodata if its pixels are nodata
+    sample_width = max(1, ceil(read_width / sample_factor))
+    sample_height = max(1, ceil(read_height / sample_factor))
+
+    if band_number > 3 or band_number == 2:
+        sample_bands = [band_number]
+        nodata_values = [0]
+    else:
+        sample_bands = list(range(1, band_number + 1))
+        nodata_values = [raster_ds.GetRasterBand(band).GetNoDataValue() for band in sample_bands]
+
+        if None in nodata_values:
+            return False
+
+    for band, nodata_value in zip(sample_bands, nodata_values):
+        sample_array = raster_ds.GetRasterBand(band).ReadAsArray(read_x_min, read_y_min, read_width, read_height,
+                                                                 buf_xsize=sample_width, buf_ysize=sample_height,
+                                                                 resample_alg=GRIORA_Average)
+
+        if (sample_array != nodata_value).any():
+            return False
+
+    # a few valid pixels can still round down to nodata in the average, the window is confirmed at full resolution
+    for band, nodata_value in zip(sample_bands, nodata_values):
+        band_array = raster_ds.GetRasterBand(band).ReadAsArray(read_x_min, read_y_min, read_width, read_height)
+
+        if (band_array != nodata_value).any():
+            return False
+
+    return True
+
+
+@profile_stage(stage_name="raster_read")
+def get_array_from_raster_window(file_path, output_bounds, raster_buffer=None, reuse_buffer=False):
+    metadata = get_raster_metadata(file_path=file_path)
+    raster_ds = open_raster(file_path=file_path)
+
+    band_number = metadata["band_number"]
+    src_geo_transform = metadata["geo_transform"]
+
+    x_off, y_off, width, height = bounds_to_window(geo_transform=src_geo_transform, output_bounds=output_bounds)
+
+    res_x = src_geo_transform[1]
+    res_y = src_geo_transform[5]
+
+    min_x = src_geo_transform[0] + x_off * res_x
+    max_y = src_geo_transform[3] + y_off * res_y
+    max_x = min_x + width * res_x
+    min_y = max_y + height * res_y
+
+    geo_transform = (min_x, res_x, 0.0, max_y, 0.0, res_y)
+
+    lon = [min_x, max_x, max_x, min_x]  # [ulx, lrx, lrx, ulx]
+    lat = [max_y, max_y, min_y, min_y]  # [uly, uly, lry, lry]
+
+    epsg = metadata["epsg"]
+
+    geom_poly = lon_lat_to_geom(lon=lon, lat=lat)
+
+    raster_bands = get_raster_band_list(band_number=band_number)
+
+    if reuse_buffer:
+        raster_buffer = get_read_array(height=height, width=width, band_count=len(raster_bands))
+    else:
+        raster_buffer = get_raster_buffer(height=height, width=width, band_count=len(raster_bands), dtype=np.uint8,
+                                          raster_buffer=raster_buffer)
+
+    # edge tiles can fall outside the raster, only the overlapping part is read and the rest stays 0
+    read_x_min, read_y_min, read_x_max, read_y_max = clip_window(raster_ds=raster_ds, x_off=x_off, y_off=y_off,
+                                                                 width=width, height=height)
+
+    if read_x_min != x_off or read_y_min != y_off or read_x_max != x_off + width or read_y_max != y_off + height:
+        raster_buffer.fill(0)
+
+    if read_x_max > read_x_min and read_y_max > read_y_min:
+        rows = slice(read_y_min - y_off, read_y_max - y_off)
+        cols = slice(read_x_min - x_off, read_x_max - x_off)
+
+        read_raster_bands(raster_ds=raster_ds, band_list=raster_bands, x_off=read_x_min, y_off=read_y_min,
+                          width=read_x_max - read_x_min, height=read_y_max - read_y_min,
+                          raster_buffer=raster_buffer[rows, cols])
+
+        add_counter(counter_name="bytes_read", value=raster_buffer[rows, cols].nbytes)
+
+    original_raster, alpha_channel = split_raster_buffer(raster_buffer=raster_buffer, band_number=band_number)
+
+    return original_raster, alpha_channel, geo_transform, min_x, max_y, res_x, res_y, width, height, epsg, geom_poly
+
+
+@profile_stage(stage_name="raster_read")
+def get_array_from_raster_overview(file_path, output_bounds, factor):
+    metadata = get_raster_metadata(file_path=file_path)
+
+    if not metadata["overview_count"]:
+        return None
+
+    raster_ds = open_raster(file_path=file_path)
+
+    band_number = metadata["band_number"]
+
+    x_off, y_off, width, height = bounds_to_window(geo_transform=metadata["geo_transform"],
+                                                   output_bounds=output_bounds)
+
+    raster_bands = get_raster_band_list(band_number=band_number)
+    raster_buffer = np.zeros((height // factor, width // factor, len(raster_bands)), dtype=np.uint8)
+
+    # only whole blocks inside the raster are read, a reduced buffer lets GDAL answer from the closest overview
+    read_x_min, read_y_min, read_x_max, read_y_max = clip_window(raster_ds=raster_ds, x_off=x_off, y_off=y_off,
+                                                                 width=width, height=height)
+
+    rows = slice(ceil((read_y_min - y_off) / factor), min((read_y_max - y_off) // factor, raster_buffer.shape[0]))
+    cols = slice(ceil((read_x_min - x_off) / factor), min((read_x_max - x_off) // factor, raster_buffer.shape[1]))
+
+    if rows.stop > rows.start and cols.stop > cols.start:
+        read_raster_bands(raster_ds=raster_ds, band_list=raster_bands, x_off=x_off + cols.start * factor,
+                          y_off=y_off + rows.start * factor, width=(cols.stop - cols.start) * factor,
+                          height=(rows.stop - rows.start) * factor, raster_buffer=raster_buffer[rows, cols],
+                          resample_alg=GRIORA_Average)
+
+        add_counter(counter_name="bytes_read", value=raster_buffer[rows, cols].nbytes)
+
+    return split_raster_buffer(raster_buffer=raster_buffer, band_number=band_number)
+
+
+def downsample_raster(raster_array, factor):
+    height = raster_array.shape[0] // factor
+    width = raster_array.shape[1] // factor
+
+    # block average like GDAL's average overviews, the sum is kept in uint32 instead of a float copy of the tile
+    raster_blocks = raster_array[:height * factor, :width * factor].reshape(height, factor, width, factor,
+                                                                            *raster_array.shape[2:])
+    block_sums = raster_blocks.sum(axis=(1, 3), dtype=np.uint32)
+
+    return ((block_sums + factor * factor // 2) // (factor * factor)).astype(raster_array.dtype)
+
+
+@profile_stage(stage_name="raster_write")
+def save_array_as_raster(raster_array, output_path, geo_transform, epsg, raster_format, alpha_channel=None,
+                         raster_profile="plain", raster_compression="NONE", overview_resampling="AVERAGE"):
+    try:
+        raster_format, creation_options = get_raster_creation_options(raster_format=raster_format,
+                                                                      raster_profile=raster_profile,
+                                                                      raster_compression=raster_compression,
+                                                                      overview_resampling=overview_resampling)
+        driver = GetDriverByName(raster_format)
+
+        if driver is None:
+            raise ValueError(f"Raster formati bulunamadi! {raster_format}")
+
+        height, width, band_number = raster_array.shape
+
+        if alpha_channel is not None:
+            band_number += 1
+
+        srs = SpatialReference()
+        srs.ImportFromEPSG(epsg)
+
+        # drivers such as PNG, JPEG or COG only support CreateCopy, they are filled through an in-memory dataset
+        if driver.GetMetadataItem(DCAP_CREATE) == 'YES':
+            output_ds = driver.Create(output_path, width, height, band_number, GDT_Byte, options=creation_options)
+        else:
+            output_ds = GetDriverByName('MEM').Create('', width, height, band_number, GDT_Byte)
+
+        output_ds.SetGeoTransform(geo_transform)
+        output_ds.SetProjection(srs.ExportToWkt())
+
+        for index in range(raster_array.shape[-1]):
+            output_ds.GetRasterBand(index + 1).WriteArray(raster_array[:, :, index])
+
+        if alpha_channel is not None:
+            alpha_band = output_ds.GetRasterBand(band_number)
+            alpha_band.SetColorInterpretation(GCI_AlphaBand)
+            alpha_band.WriteArray(alpha_channel)
+
+        if driver.GetMetadataItem(DCAP_CREATE) != 'YES':
+            _ = driver.CreateCopy(output_path, output_ds, options=creation_options)
+            _ = None
+
+        output_ds = None
+
+        if file_exists(file_path=output_path):
+            add_counter(counter_name="bytes_written", value=get_file_size(file_path=output_path))
+
+        return True
+    except Exception as error:
+        print(f"Raster kaydedilirken hata olustu: {error} - {output_path}")
+        return False
+
+
+def get_byte_lut(dtype):
+    if dtype not in byte_luts:
+        info = np.iinfo(dtype)
+        byte_luts[dtype] = (255 * (np.arange(info.max + 1, dtype=np.float32) / info.max)).astype(np.uint8)
+
+    return byte_luts[dtype]
+
+
+def normalize_byte(raster_array, out=None):
+    if raster_array.dtype == np.uint8:
+        if out is None:
+            return raster_array
+
+        np.copyto(out, raster_array)
+
+        return out
+
+    # 8/16-bit unsigned values are mapped through a lookup table instead of a float32 copy of the tile
+    if raster_array.dtype.kind == 'u' and raster_array.dtype.itemsize <= 2:
+        return np.take(get_byte_lut(dtype=raster_array.dtype), raster_array, out=out, mode='clip')
+
     info = np.iinfo(raster_array.dtype)
     raster_array = raster_array.astype(np.float32) / info.max
     raster_array = 255 * raster_array
 
-    return raster_array.astype(np.uint8)
+    if out is None:
+        return raster_array.astype(np.uint8)
+
+    np.copyto(out, raster_array, casting='unsafe')
+
+    return out
+
+
+def get_png_array(height, width, band_count):
+    # one output buffer per thread, reused for every tile of the same size
+    png_array = getattr(thread_buffers, "png_array", None)
+
+    if png_array is None or png_array.shape != (height, width, band_count):
+        png_array = np.empty((height, width, band_count), dtype=np.uint8)
+        thread_buffers.png_array = png_array
+
+    return png_array
+
+
+def encode_png_with_pil(raster_array, png_compression=6):
+    if raster_array.shape[-1] == 1:
+        raster_array = raster_array[:, :, 0]
+
+    png_buffer = BytesIO()
+    Image.fromarray(np.ascontiguousarray(raster_array)).save(png_buffer, format='PNG', compress_level=png_compression)
+
+    return png_buffer.getvalue()
+
+
+def encode_png_with_gdal(raster_array, png_compression=6):
+    if raster_array.dtype != np.uint8:
+        raster_array = np.clip(raster_array, 0, 255).astype(np.uint8)
+
+    # the NumPy driver reads the pixel-interleaved buffer through a band-first view, the pixels are not copied
+    mem_ds = OpenArray(raster_array.transpose(2, 0, 1))
+
+    png_path = f'/vsimem/{getpid()}_{get_ident()}.png'
+
+    # the returned dataset is not kept, it is closed and flushed to /vsimem right away
+    GetDriverByName('PNG').CreateCopy(png_path, mem_ds, options=[f'ZLEVEL={png_compression}'])
+    mem_ds = None
+
+    png_size = VSIStatL(png_path).size
+    png_file = VSIFOpenL(png_path, 'rb')
+    png_bytes = VSIFReadL(1, png_size, png_file)
+    VSIFCloseL(png_file)
+    Unlink(png_path)
+
+    return png_bytes
+
+
+def encode_png_with_matplotlib(raster_array):
+    # pyplot is slow to import, it is only loaded when this backend is asked for
+    import matplotlib.pyplot as plt
+
+    if raster_array.shape[-1] == 1:
+        raster_array = np.dstack([raster_array[:, :, 0], raster_array[:, :, 0], raster_array[:, :, 0]])
 
+    png_buffer = BytesIO()
+    plt.imsave(png_buffer, raster_array, format='png')
 
-def save_raster_as_png(raster_array, output_path, generate_alpha, normalize=True, alpha_channel=None):
-    if normalize:
-        result_array = normalize_byte(raster_array=raster_array)
+    return png_buffer.getvalue()
+
+
+@profile_stage(stage_name="png_encode")
+def encode_raster_as_png(raster_array, generate_alpha, normalize=True, alpha_channel=None, png_backend="pil",
+                         png_compression=6):
+    height, width, band_count = raster_array.shape
+
+    if not generate_alpha:
+        # uint8 tiles are encoded as they are, other types are normalized into the reused buffer
+        if normalize and raster_array.dtype != np.uint8:
+            result_array = normalize_byte(raster_array=raster_array,
+                                          out=get_png_array(height=height, width=width, band_count=band_count))
+        else:
+            result_array = raster_array
     else:
-        result_array = raster_array.copy()
-
-    if generate_alpha:
-        if raster_array.shape[-1] == 3:
-            if alpha_channel is None:
-                alpha_channel = ((raster_array[:, :, 0] > 0) | (raster_array[:, :, 1] > 0) |
-                                 (raster_array[:, :, 2] > 0)) * np.uint8(255)
-            result_array = np.dstack([result_array[:, :, 0], result_array[:, :, 1], result_array[:, :, 2],
-                                      alpha_channel])
+        result_array = get_png_array(height=height, width=width, band_count=4)
+
+        if band_count == 3:
+            color_bands = 3
         else:
-            if alpha_channel is None:
-                alpha_channel = raster_array[:, :, 0].copy()
-            result_array = np.dstack([result_array[:, :, 0], result_array[:, :, 0], result_array[:, :, 0],
-                                      alpha_channel])
+            color_bands = 1
 
-    if raster_array.shape[-1] == 1:
-        result_array = np.dstack([result_array[:, :, 0], result_array[:, :, 0], result_array[:, :, 0]])
+        if normalize:
+            normalize_byte(raster_array=raster_array[:, :, :color_bands], out=result_array[:, :, :color_bands])
+        else:
+            np.copyto(result_array[:, :, :color_bands], raster_array[:, :, :color_bands], casting='unsafe')
+
+        if color_bands == 1:
+            result_array[:, :, 1] = result_array[:, :, 0]
+            result_array[:, :, 2] = result_array[:, :, 0]
+
+        if alpha_channel is not None:
+            result_array[:, :, 3] = alpha_channel
+        elif color_bands == 3:
+            np.multiply(np.any(raster_array, axis=2), np.uint8(255), out=result_array[:, :, 3])
+        else:
+            result_array[:, :, 3] = result_array[:, :, 0]
+
+    if png_backend == "gdal":
+        return encode_png_with_gdal(raster_array=result_array, png_compression=png_compression)
+    elif png_backend == "matplotlib":
+        return encode_png_with_matplotlib(raster_array=result_array)
+    else:
+        return encode_png_with_pil(raster_array=result_array, png_compression=png_compression)
+
+
+def save_raster_as_png(raster_array, output_path, generate_alpha, normalize=True, alpha_channel=None,
+                       png_backend="pil", png_compression=6):
+    png_bytes = encode_raster_as_png(raster_array=raster_array, generate_alpha=generate_alpha, normalize=normalize,
+                                     alpha_channel=alpha_channel, png_backend=png_backend,
+                                     png_compression=png_compression)
 
-    plt.imsave(output_path, result_array, format='png')
+    write_bytes(output_path=output_path, data=png_bytes)
 
     return output_path
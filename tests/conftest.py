@@ -0,0 +1,9 @@
+"""
+Author: Resul Emre AYGAN
+"""
+
+import sys
+from os import path
+
+# the modules live in the repository root, not in a package
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
@@ -0,0 +1,349 @@
+"""
+Author: Resul Emre AYGAN
+"""
+
+import numpy as np
+import pytest
+from PIL import Image
+from shapely.geometry import Polygon, MultiPolygon, LineString, box
+from skimage import measure
+
+from coco_operations import color_mapping, create_label_annotations, get_category_masks, deduplicate_tile_annotations, \
+    create_vector_annotations, create_component_annotations, scale_annotations
+
+
+def legacy_create_sub_masks(mask_image, colors):
+    # per pixel getpixel loop the vectorized masks replaced, kept as the reference
+    width, height = mask_image.size
+
+    sub_masks = {}
+
+    for x in range(width):
+        for y in range(height):
+            pixel = mask_image.getpixel((x, y))
+
+            if pixel in colors:
+                sub_mask = sub_masks.get(pixel)
+                if sub_mask is None:
+                    sub_masks[pixel] = Image.new("1", (width + 2, height + 2))
+
+                sub_masks[pixel].putpixel((x + 1, y + 1), 1)
+
+    return sub_masks
+
+
+def legacy_create_sub_mask_annotation(sub_mask, image_id, category_id, annotation_id, is_crowd):
+    contours = measure.find_contours(np.asarray(sub_mask), 0.5, positive_orientation="low")
+
+    annotations = []
+    for contour in contours:
+        for i in range(len(contour)):
+            row, col = contour[i]
+            contour[i] = (col - 1, row - 1)
+
+        poly = Polygon(contour)
+        poly = poly.simplify(1.0, preserve_topology=False)
+        if not poly.is_empty:
+            segmentation = np.array(poly.exterior.coords).ravel().tolist()
+
+            x, y, max_x, max_y = poly.bounds
+            width = max_x - x
+            height = max_y - y
+            bbox = (x, y, width, height)
+            area = poly.area
+
+            annotation = {
+                "segmentation": [segmentation],
+                "iscrowd": int(is_crowd),
+                "image_id": int(image_id),
+                "category_id": int(category_id),
+                "id": int(annotation_id),
+                "bbox": bbox,
+                "area": area,
+            }
+
+            annotation_id += 1
+            annotations.append(annotation)
+
+    last_annotation_id = annotation_id
+    return last_annotation_id, annotations
+
+
+def create_label_array():
+    label_array = np.zeros((40, 48), dtype=np.uint8)
+
+    # touching buildings of different categories
+    label_array[4:12, 4:12] = color_mapping["undamaged"]["id"]
+    label_array[4:12, 12:20] = color_mapping["damaged"]["id"]
+
+    # buildings of the same category touching at a corner
+    label_array[14:18, 4:8] = color_mapping["damaged"]["id"]
+    label_array[18:22, 8:12] = color_mapping["damaged"]["id"]
+
+    # building with a courtyard
+    label_array[16:30, 20:34] = color_mapping["uncertain"]["id"]
+    label_array[20:26, 24:30] = 0
+
+    # buildings clipped by the tile edges and corner
+    label_array[0:6, 30:40] = color_mapping["undamaged"]["id"]
+    label_array[30:40, 0:7] = color_mapping["uncertain"]["id"]
+    label_array[34:40, 41:48] = color_mapping["damaged"]["id"]
+
+    # single pixel that is simplified away
+    label_array[36, 20] = color_mapping["undamaged"]["id"]
+
+    return label_array
+
+
+def label_to_rgb_image(label_array):
+    rgb_array = np.zeros(label_array.shape + (3,), dtype=np.uint8)
+
+    for category in color_mapping.values():
+        rgb_array[label_array == category["id"]] = category["rgb"]
+
+    return Image.fromarray(rgb_array)
+
+
+def assert_annotations_equal(annotations, legacy_annotations):
+    assert len(annotations) == len(legacy_annotations)
+
+    for annotation, legacy_annotation in zip(annotations, legacy_annotations):
+        assert annotation["category_id"] == legacy_annotation["category_id"]
+        assert annotation["image_id"] == legacy_annotation["image_id"]
+        assert annotation["iscrowd"] == legacy_annotation["iscrowd"]
+        assert annotation["bbox"] == pytest.approx(legacy_annotation["bbox"])
+        assert annotation["area"] == pytest.approx(legacy_annotation["area"])
+        assert len(annotation["segmentation"]) == len(legacy_annotation["segmentation"])
+
+        for segmentation, legacy_segmentation in zip(annotation["segmentation"], legacy_annotation["segmentation"]):
+            assert segmentation == pytest.approx(legacy_segmentation)
+
+
+def test_category_masks_match_legacy_sub_masks():
+    label_array = create_label_array()
+    colors = [tuple(category["rgb"]) for category in color_mapping.values()]
+
+    legacy_sub_masks = legacy_create_sub_masks(mask_image=label_to_rgb_image(label_array=label_array), colors=colors)
+    category_masks = get_category_masks(label_array=label_array, category_names=list(color_mapping),
+                                        categories=color_mapping)
+
+    for category_name, category in color_mapping.items():
+        category_mask = np.pad(category_masks[category_name], 1)
+        legacy_sub_mask = legacy_sub_masks.get(tuple(category["rgb"]))
+
+        if legacy_sub_mask is None:
+            assert not category_mask.any()
+        else:
+            np.testing.assert_array_equal(category_mask, np.asarray(legacy_sub_mask))
+
+
+def test_category_masks_of_a_single_buildings_category():
+    label_array = create_label_array()
+    categories = {"buildings": {"id": 1}}
+
+    category_masks = get_category_masks(label_array=label_array, category_names=[], categories=categories)
+
+    assert list(category_masks) == ["buildings"]
+    np.testing.assert_array_equal(category_masks["buildings"], label_array > 0)
+    assert get_category_masks(label_array=label_array, category_names=[], categories={}) == {}
+
+
+def test_label_annotations_match_legacy_annotations():
+    label_array = create_label_array()
+    colors = [tuple(category["rgb"]) for category in color_mapping.values()]
+
+    legacy_sub_masks = legacy_create_sub_masks(mask_image=label_to_rgb_image(label_array=label_array), colors=colors)
+
+    category_masks = get_category_masks(label_array=label_array, category_names=list(color_mapping),
+                                        categories=color_mapping)
+    last_annotation_id, annotations = create_label_annotations(category_masks=category_masks,
+                                                               image_id=3, is_crowd=False, categories=color_mapping)
+
+    assert [annotation["id"] for annotation in annotations] == list(range(1, last_annotation_id))
+
+    for category_name, category in color_mapping.items():
+        legacy_sub_mask = legacy_sub_masks.get(tuple(category["rgb"]))
+
+        if legacy_sub_mask is None:
+            legacy_annotations = []
+        else:
+            _, legacy_annotations = legacy_create_sub_mask_annotation(sub_mask=legacy_sub_mask, image_id=3,
+                                                                      category_id=category["id"], annotation_id=1,
+                                                                      is_crowd=False)
+
+        category_annotations = [annotation for annotation in annotations
+                                if annotation["category_id"] == category["id"]]
+
+        assert_annotations_equal(annotations=category_annotations, legacy_annotations=legacy_annotations)
+
+
+def test_label_annotations_of_empty_tile():
+    label_array = np.zeros((16, 16), dtype=np.uint8)
+
+    category_masks = get_category_masks(label_array=label_array, category_names=list(color_mapping),
+                                        categories=color_mapping)
+    last_annotation_id, annotations = create_label_annotations(category_masks=category_masks,
+                                                               image_id=0, is_crowd=False, categories=color_mapping)
+
+    assert last_annotation_id == 1
+    assert annotations == []
+
+
+def box_annotation(name, x_min, y_min, x_max, y_max, category_id=1):
+    return {"name": name, "category_id": category_id,
+            "segmentation": [[x_min, y_min, x_max, y_min, x_max, y_max, x_min, y_max]]}
+
+
+def create_coco_tile(x_origin, annotations, scene="scene.tif"):
+    # 10 x 10 pixel tiles of one meter, neighbours overlap by 4 pixels
+    return {"annotations": annotations, "scene": scene, "geo_transform": (x_origin, 1.0, 0.0, 10.0, 0.0, -1.0),
+            "width": 10, "height": 10}
+
+
+def test_deduplicate_merges_border_fragments():
+    # the building is whole in the left tile and cut by the border of the right one
+    coco_tiles = [create_coco_tile(x_origin=0.0, annotations=[box_annotation("full", 5, 4, 9, 8)]),
+                  create_coco_tile(x_origin=6.0, annotations=[box_annotation("fragment", 0, 4, 3, 8)])]
+
+    tile_annotations = deduplicate_tile_annotations(coco_tiles=coco_tiles)
+
+    assert [[annotation["name"] for annotation in annotations] for annotations in tile_annotations] == [["full"], []]
+
+
+def test_deduplicate_keeps_buildings_apart():
+    # overlapping annotations of one tile, another category and another scene are different buildings
+    coco_tiles = [create_coco_tile(x_origin=0.0, annotations=[box_annotation("left", 6, 4, 9, 8),
+                                                              box_annotation("right", 7, 4, 10, 8)]),
+                  create_coco_tile(x_origin=6.0, annotations=[box_annotation("other_category", 0, 4, 3, 8,
+                                                                             category_id=2)]),
+                  create_coco_tile(x_origin=6.0, annotations=[box_annotation("other_scene", 0, 4, 3, 8)],
+                                   scene="other_scene.tif")]
+
+    tile_annotations = deduplicate_tile_annotations(coco_tiles=coco_tiles)
+
+    assert [[annotation["name"] for annotation in annotations] for annotations in tile_annotations] == [
+        ["left", "right"], ["other_category"], ["other_scene"]]
+
+
+def test_deduplicate_without_annotations():
+    coco_tiles = [create_coco_tile(x_origin=0.0, annotations=[]), create_coco_tile(x_origin=6.0, annotations=[])]
+
+    assert deduplicate_tile_annotations(coco_tiles=coco_tiles) == [[], []]
+
+
+def test_vector_annotation_area_matches_its_segmentation():
+    # a building with a courtyard, the second footprint is split by the clip
+    courtyard = Polygon([(2, 2), (12, 2), (12, 12), (2, 12)], holes=[[(5, 5), (9, 5), (9, 9), (5, 9)]])
+    split_footprint = MultiPolygon([Polygon([(20, 0), (24, 0), (24, 3)]), Polygon([(20, 6), (22, 6), (22, 8)])])
+    geometries = np.array([courtyard, split_footprint, LineString([(0, 0), (4, 4)])], dtype=object)
+
+    last_annotation_id, annotations = create_vector_annotations(geometries=geometries, category_ids=[1, 2, 3],
+                                                                image_id=5, is_crowd=False)
+
+    assert last_annotation_id == 3
+    assert [annotation["category_id"] for annotation in annotations] == [1, 2]
+    assert [len(annotation["segmentation"]) for annotation in annotations] == [1, 2]
+    assert annotations[0]["bbox"] == pytest.approx((2, 2, 10, 10))
+
+    for annotation, area in zip(annotations, [100.0, 8.0]):
+        segmentation_area = sum(Polygon(np.reshape(ring, (-1, 2))).area for ring in annotation["segmentation"])
+
+        assert annotation["area"] == pytest.approx(area)
+        assert annotation["area"] == pytest.approx(segmentation_area)
+
+
+def create_instance_array():
+    instance_array = np.zeros((20, 30), dtype=np.int32)
+
+    # touching buildings of the same category, the first one has a second part away from it
+    instance_array[2:8, 2:8] = 1
+    instance_array[2:8, 8:14] = 2
+    instance_array[17:19, 20:22] = 1
+
+    # building with a courtyard next to a building without a category
+    instance_array[10:16, 2:12] = 3
+    instance_array[12:14, 4:8] = 0
+    instance_array[10:16, 12:18] = 4
+
+    return instance_array
+
+
+def test_component_annotations_keep_touching_buildings_apart():
+    instance_array = create_instance_array()
+    instance_categories = [0, 1, 1, 2, 0]
+
+    last_annotation_id, annotations = create_component_annotations(instance_array=instance_array,
+                                                                   instance_categories=instance_categories,
+                                                                   image_id=4, is_crowd=False)
+
+    assert [annotation["id"] for annotation in annotations] == list(range(1, last_annotation_id))
+    assert all(annotation["image_id"] == 4 for annotation in annotations)
+
+    # every building is traced as if it were alone in the tile
+    instance_annotations = []
+
+    for instance_index, category_id in enumerate(instance_categories):
+        if category_id == 0:
+            continue
+
+        instance_annotations.extend(create_label_annotations(
+            category_masks={"building": instance_array == instance_index}, image_id=4, is_crowd=False,
+            categories={"building": {"id": category_id}})[1])
+
+    assert len(annotations) == len(instance_annotations) == 5
+    assert_annotations_equal(annotations=sorted(annotations, key=lambda annotation: annotation["bbox"]),
+                             legacy_annotations=sorted(instance_annotations, key=lambda annotation: annotation["bbox"]))
+
+    # the category mask of the contours engine merges the touching buildings into one
+    category_annotations = create_label_annotations(category_masks={"building": np.isin(instance_array, [1, 2])},
+                                                    image_id=4, is_crowd=False,
+                                                    categories={"building": {"id": 1}})[1]
+
+    assert len(category_annotations) == 2
+    assert len([annotation for annotation in annotations if annotation["category_id"] == 1]) == 3
+
+
+@pytest.mark.parametrize("factor", [1, 2, 4])
+def test_scaled_vector_annotations_match_the_level(factor):
+    # vector annotations are in pixel corners, a level pixel covers factor x factor base pixels
+    footprints = [box(4, 8, 20, 16), Polygon([(8, 0), (16, 0), (16, 8)])]
+    level_footprints = [box(4 / factor, 8 / factor, 20 / factor, 16 / factor),
+                        Polygon([(8 / factor, 0), (16 / factor, 0), (16 / factor, 8 / factor)])]
+
+    _, annotations = create_vector_annotations(geometries=np.array(footprints, dtype=object), category_ids=[1, 2],
+                                               image_id=0, is_crowd=False)
+    _, level_annotations = create_vector_annotations(geometries=np.array(level_footprints, dtype=object),
+                                                     category_ids=[1, 2], image_id=0, is_crowd=False)
+
+    assert_annotations_equal(annotations=scale_annotations(annotations=annotations, factor=factor),
+                             legacy_annotations=level_annotations)
+
+
+@pytest.mark.parametrize("factor", [1, 2, 4])
+def test_scaled_contour_annotations_match_the_level(factor):
+    # traced contours are in pixel centers, the buildings are aligned to every level so its mask is exact
+    label_array = np.zeros((32, 48), dtype=np.uint8)
+    label_array[8:16, 4:20] = 1
+    label_array[20:32, 24:48] = 1
+    level_array = label_array.reshape(32 // factor, factor, 48 // factor, factor).max(axis=(1, 3))
+
+    categories = {"buildings": {"id": 1}}
+    _, annotations = create_label_annotations(category_masks={"buildings": label_array > 0}, image_id=0,
+                                              is_crowd=False, categories=categories)
+    _, level_annotations = create_label_annotations(category_masks={"buildings": level_array > 0}, image_id=0,
+                                                    is_crowd=False, categories=categories)
+    scaled_annotations = scale_annotations(annotations=annotations, factor=factor, pixel_offset=0.5)
+
+    assert len(scaled_annotations) == len(level_annotations) == 2
+
+    for scaled_annotation, level_annotation, annotation in zip(scaled_annotations, level_annotations, annotations):
+        scaled_coords = np.reshape(scaled_annotation["segmentation"][0], (-1, 2))
+        scaled_bbox = scaled_annotation["bbox"]
+
+        assert scaled_annotation["area"] == pytest.approx(annotation["area"] / factor ** 2)
+        assert scaled_bbox[:2] == pytest.approx(tuple(scaled_coords.min(axis=0)))
+        assert scaled_bbox[2:] == pytest.approx(tuple(scaled_coords.max(axis=0) - scaled_coords.min(axis=0)))
+
+        # simplify cuts the corners of each level on its own pixel grid, they agree within half a level pixel
+        assert scaled_bbox == pytest.approx(level_annotation["bbox"], abs=0.5)
+        assert scaled_annotation["area"] == pytest.approx(level_annotation["area"], abs=0.5 * sum(scaled_bbox[2:]))
@@ -0,0 +1,31 @@
+"""
+Author: Resul Emre AYGAN
+"""
+
+import geopandas as gpd
+import pytest
+from shapely.geometry import Polygon, box
+
+pytest.importorskip("osgeo")
+
+from geometry_operations import get_vector_index, clip_gdf_with_polygon, vector_indexes  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def cleared_vector_indexes():
+    yield
+    vector_indexes.clear()
+
+
+def test_invalid_footprints_are_clipped(tmp_path):
+    shapefile_path = str(tmp_path / "buildings.shp")
+    # a bow-tie footprint crosses itself, the square next to it is valid
+    footprints = [Polygon([(0, 0), (10, 10), (10, 0), (0, 10)]), box(20, 0, 30, 10)]
+    gpd.GeoDataFrame({"damage_gra": ["1", "2"]}, geometry=footprints, crs="EPSG:3857").to_file(shapefile_path)
+
+    vector_data, vector_index = get_vector_index(shapefile_path=shapefile_path)
+    clipped_data = clip_gdf_with_polygon(gdf_data=vector_data, spatial_index=vector_index, polygon=box(0, 0, 25, 10))
+
+    assert list(clipped_data["damage_gra"]) == ["1", "2"]
+    assert clipped_data.geometry.is_valid.all()
+    assert clipped_data.geometry.area.tolist() == pytest.approx([50.0, 50.0])
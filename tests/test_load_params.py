@@ -0,0 +1,84 @@
+"""
+Author: Resul Emre AYGAN
+"""
+
+import json
+
+import pytest
+
+from utils.load_params import load_config
+
+
+def write_config(config_dir, **params):
+    raster_path = config_dir / "scene.tif"
+    raster_path.write_bytes(b"")
+    (config_dir / "output").mkdir()
+
+    config = {
+        "crop_size_x": 512,
+        "crop_size_y": 512,
+        "raster_path": str(raster_path),
+        "output_dir": str(config_dir / "output"),
+        "raster_format": "GTIFF",
+        "save_as_png": True,
+        "crop_shape": False,
+        "shape_path": "",
+        "seg_mask": True,
+        "seg_mask_as_png": True,
+        "convert_coco": True,
+        "visualize_coco": False,
+        "coco_annotations_path": "",
+        "annotations_image_dir_path": "",
+        "drawn_annotations_path": "",
+        "calculate_annotations_analysis": False,
+        **params,
+    }
+
+    (config_dir / "config.json").write_text(json.dumps(config))
+
+    return config
+
+
+def test_config_without_later_keys(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_config(config_dir=tmp_path)
+
+    config = load_config()
+
+    assert config["raster_paths"] == [str(tmp_path / "scene.tif")]
+    assert config["num_workers"] == 1
+    assert config["skip_empty_tiles"] is False
+    assert config["pipeline"] is False
+    assert config["png_backend"] == "pil"
+    assert config["pyramid_levels"] == [1]
+    assert config["tile_overlap"] == 0
+
+    # coco conversion needs the footprints
+    assert config["convert_coco"] is False
+
+
+def test_config_with_later_keys(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_config(config_dir=tmp_path, num_workers=4, pyramid_levels=[4, 1, 2, 2], annotation_engine="vectors")
+
+    config = load_config()
+
+    assert config["num_workers"] == 4
+    assert config["pyramid_levels"] == [1, 2, 4]
+    assert config["annotation_engine"] == "vectors"
+
+
+def test_config_with_invalid_value(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_config(config_dir=tmp_path, png_backend="cv2")
+
+    with pytest.raises(Exception, match="png_backend"):
+        load_config()
+
+
+def test_config_with_pipeline_and_workers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_config(config_dir=tmp_path, pipeline=True, num_workers=4)
+
+    with pytest.raises(Exception, match="num_workers"):
+        load_config()
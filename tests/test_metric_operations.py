@@ -0,0 +1,62 @@
+"""
+Author: Resul Emre AYGAN
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from pstats import Stats
+
+import pytest
+
+from utils.metric_operations import profile_stage, reset_metrics, take_metrics, merge_metrics, get_metrics_report, \
+    dump_stage_profiles
+
+
+def count_pixels(pixel_count):
+    return sum(range(pixel_count))
+
+
+@profile_stage(stage_name="tile_work")
+def run_tile_work(pixel_count):
+    return count_pixels(pixel_count=pixel_count)
+
+
+def run_worker_tile(pixel_count):
+    run_tile_work(pixel_count=pixel_count)
+
+    return take_metrics()
+
+
+@pytest.fixture(autouse=True)
+def cleared_metrics():
+    reset_metrics()
+    yield
+    reset_metrics()
+
+
+def test_worker_profiles_are_merged_and_dumped_once(tmp_path):
+    reset_metrics(stage_names=("tile_work",))
+
+    with ProcessPoolExecutor(max_workers=2, initializer=reset_metrics, initargs=(("tile_work",),)) as executor:
+        for metrics in executor.map(run_worker_tile, [1000] * 6):
+            merge_metrics(metrics=metrics)
+
+    # the main process profiles its own stages too
+    merge_metrics(metrics=run_worker_tile(pixel_count=1000))
+
+    assert get_metrics_report(wall_seconds=1.0)["stages"]["tile_work"]["count"] == 7
+
+    profile_paths = dump_stage_profiles(output_dir=str(tmp_path))
+
+    assert profile_paths == [str(tmp_path / "tile_work.prof")]
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["tile_work.prof"]
+
+    call_counts = {func[2]: stat[1] for func, stat in Stats(profile_paths[0]).stats.items()}
+
+    assert call_counts["count_pixels"] == 7
+
+
+def test_metrics_without_profiles(tmp_path):
+    merge_metrics(metrics=run_worker_tile(pixel_count=10))
+
+    assert "profiles" not in take_metrics()
+    assert dump_stage_profiles(output_dir=str(tmp_path)) == []
@@ -0,0 +1,59 @@
+"""
+Author: Resul Emre AYGAN
+"""
+
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip("osgeo")
+
+from raster_operations import encode_raster_as_png, png_backends  # noqa: E402
+
+
+def decode_png(png_bytes):
+    return np.asarray(Image.open(BytesIO(png_bytes)))
+
+
+def create_raster_array(band_count, dtype=np.uint8):
+    rng = np.random.default_rng(seed=band_count)
+    raster_array = rng.integers(0, 255, size=(33, 47, band_count)).astype(dtype)
+
+    # a nodata corner so the generated alpha band is not all opaque
+    raster_array[:10, :10] = 0
+
+    return raster_array
+
+
+def get_color_bands(png_array, band_count):
+    # matplotlib always writes RGBA, a single band is written as gray RGB
+    if png_array.ndim == 2:
+        png_array = png_array[:, :, np.newaxis]
+
+    return png_array[:, :, :band_count]
+
+
+@pytest.mark.parametrize("png_backend", png_backends)
+@pytest.mark.parametrize("band_count", [1, 3, 4])
+def test_png_backends_write_the_same_pixels(png_backend, band_count):
+    raster_array = create_raster_array(band_count=band_count)
+
+    png_bytes = encode_raster_as_png(raster_array=raster_array, generate_alpha=False, png_backend=png_backend)
+
+    assert png_bytes.startswith(b"\x89PNG")
+    np.testing.assert_array_equal(get_color_bands(png_array=decode_png(png_bytes=png_bytes), band_count=band_count),
+                                  raster_array)
+
+
+@pytest.mark.parametrize("png_backend", png_backends)
+@pytest.mark.parametrize("band_count", [1, 3])
+def test_png_backends_write_the_same_alpha(png_backend, band_count):
+    raster_array = create_raster_array(band_count=band_count, dtype=np.uint16)
+
+    png_bytes = encode_raster_as_png(raster_array=raster_array, generate_alpha=True, png_backend=png_backend)
+    reference_bytes = encode_raster_as_png(raster_array=raster_array, generate_alpha=True, png_backend="pil")
+
+    np.testing.assert_array_equal(decode_png(png_bytes=png_bytes), decode_png(png_bytes=reference_bytes))
+    assert (decode_png(png_bytes=png_bytes)[:10, :10, 3] == 0).all()
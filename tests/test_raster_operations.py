@@ -0,0 +1,159 @@
+"""
+Author: Resul Emre AYGAN
+"""
+
+from gc import collect
+from threading import Thread
+from weakref import ref
+
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip("osgeo.gdal")
+
+from osgeo.osr import SpatialReference  # noqa: E402
+
+from raster_operations import get_array_from_raster, get_raster_band_list, close_rasters  # noqa: E402
+from raster_operations import get_raster_metadata, raster_datasets, is_raster_window_empty  # noqa: E402
+from raster_operations import get_png_array, get_read_array  # noqa: E402
+
+
+def write_test_raster(output_path, band_count, dtype=gdal.GDT_UInt16, width=61, height=43):
+    rng = np.random.default_rng(seed=band_count)
+    band_arrays = [rng.integers(0, 400, size=(height, width)) for _ in range(band_count)]
+
+    raster_ds = gdal.GetDriverByName('GTiff').Create(str(output_path), width, height, band_count, dtype)
+    raster_ds.SetGeoTransform((30.0, 0.001, 0.0, 38.0, 0.0, -0.001))
+
+    srs = SpatialReference()
+    srs.ImportFromEPSG(4326)
+    raster_ds.SetProjection(srs.ExportToWkt())
+
+    for band_index, band_array in enumerate(band_arrays, start=1):
+        raster_ds.GetRasterBand(band_index).WriteArray(band_array)
+
+    raster_ds = None
+
+    return str(output_path)
+
+
+def write_byte_raster(output_path, band_arrays, nodata_value=None):
+    height, width = band_arrays[0].shape
+
+    raster_ds = gdal.GetDriverByName('GTiff').Create(str(output_path), width, height, len(band_arrays), gdal.GDT_Byte)
+    raster_ds.SetGeoTransform((30.0, 0.001, 0.0, 38.0, 0.0, -0.001))
+
+    for band_index, band_array in enumerate(band_arrays, start=1):
+        raster_ds.GetRasterBand(band_index).WriteArray(band_array)
+
+        if nodata_value is not None:
+            raster_ds.GetRasterBand(band_index).SetNoDataValue(nodata_value)
+
+    raster_ds = None
+
+    return str(output_path)
+
+
+def read_bands_one_by_one(file_path, window):
+    # the per band reads the pixel-interleaved read replaced, kept as the reference
+    raster_ds = gdal.Open(file_path)
+    raster_bands = get_raster_band_list(band_number=raster_ds.RasterCount)
+
+    band_arrays = [raster_ds.GetRasterBand(band).ReadAsArray(*window) for band in raster_bands]
+
+    if raster_ds.RasterCount > 3 or raster_ds.RasterCount == 2:
+        return np.dstack(band_arrays[:-1]), np.clip(band_arrays[-1], 0, 255).astype(np.uint8)
+
+    return np.dstack(band_arrays), None
+
+
+@pytest.fixture(autouse=True)
+def closed_rasters():
+    yield
+    close_rasters()
+
+
+@pytest.mark.parametrize("band_count", [1, 2, 3, 4, 5])
+@pytest.mark.parametrize("window", [None, (7, 5, 32, 24)])
+def test_interleaved_read_matches_band_reads(tmp_path, band_count, window):
+    file_path = write_test_raster(output_path=tmp_path / "scene.tif", band_count=band_count)
+
+    original_raster, alpha_channel, *_, width, height, _, _ = get_array_from_raster(file_path=file_path,
+                                                                                    only_info=False, window=window)
+    reference_raster, reference_alpha = read_bands_one_by_one(file_path=file_path, window=window or (0, 0, 61, 43))
+
+    assert (width, height) == reference_raster.shape[1::-1]
+    np.testing.assert_array_equal(original_raster, reference_raster)
+
+    if reference_alpha is None:
+        assert alpha_channel is None
+    else:
+        np.testing.assert_array_equal(alpha_channel, reference_alpha)
+
+
+def test_interleaved_read_reuses_the_buffer(tmp_path):
+    file_path = write_test_raster(output_path=tmp_path / "scene.tif", band_count=3)
+    raster_buffer = np.empty((24, 32, 3), dtype=np.uint16)
+
+    original_raster = get_array_from_raster(file_path=file_path, only_info=False, window=(7, 5, 32, 24),
+                                            raster_buffer=raster_buffer)[0]
+
+    assert np.shares_memory(original_raster, raster_buffer)
+
+
+def test_metadata_is_cached_until_the_raster_changes(tmp_path):
+    file_path = write_test_raster(output_path=tmp_path / "scene.tif", band_count=3)
+
+    metadata = get_raster_metadata(file_path=file_path)
+
+    assert get_raster_metadata(file_path=file_path) is metadata
+
+    # the handles are gone but the metadata is kept, like in a forked tile worker
+    raster_datasets.clear()
+    write_test_raster(output_path=tmp_path / "scene.tif", band_count=4, width=50)
+
+    metadata = get_raster_metadata(file_path=file_path)
+
+    assert metadata["band_number"] == 4
+    assert metadata["width"] == 50
+
+
+@pytest.mark.parametrize("band_count, nodata_value, pixel_value, is_empty", [
+    (4, None, 0, True),
+    # a single half transparent pixel averages to 0 over its sample block
+    (4, None, 100, False),
+    (3, 0, 0, True),
+    (3, 0, 1, False),
+    (3, None, 0, False),
+])
+def test_empty_window(tmp_path, band_count, nodata_value, pixel_value, is_empty):
+    band_arrays = [np.full((64, 64), 200, dtype=np.uint8) for _ in range(band_count - 1)]
+    band_arrays.append(np.zeros((64, 64), dtype=np.uint8))
+
+    if band_count == 3:
+        band_arrays = [np.zeros((64, 64), dtype=np.uint8) for _ in range(band_count)]
+
+    band_arrays[-1][37, 21] = pixel_value
+
+    file_path = write_byte_raster(output_path=tmp_path / "scene.tif", band_arrays=band_arrays,
+                                  nodata_value=nodata_value)
+
+    assert is_raster_window_empty(file_path=file_path, output_bounds=(30.0, 38.0, 30.064, 37.936)) == is_empty
+
+
+def test_thread_buffers_are_freed_with_their_thread():
+    assert get_png_array(height=8, width=8, band_count=3) is get_png_array(height=8, width=8, band_count=3)
+
+    buffer_refs = []
+
+    def encode_tile():
+        buffer_refs.append(ref(get_png_array(height=8, width=8, band_count=3)))
+        buffer_refs.append(ref(get_read_array(height=8, width=8, band_count=3)))
+
+    encoder_thread = Thread(target=encode_tile)
+    encoder_thread.start()
+    encoder_thread.join()
+    collect()
+
+    assert len(buffer_refs) == 2
+    assert all(buffer_ref() is None for buffer_ref in buffer_refs)
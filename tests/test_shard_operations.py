@@ -0,0 +1,109 @@
+"""
+Author: Resul Emre AYGAN
+"""
+
+from os import path
+
+import pytest
+
+from utils.file_operations import append_json_line, iter_json_lines, load_json_line, file_checksum, file_signature, \
+    repair_json_lines
+from utils.shard_operations import open_shard_writer, write_shard_tile, close_shard_writer, close_shard_files, \
+    read_shard_file, get_output_signature, get_output_checksum
+
+
+@pytest.fixture(autouse=True)
+def closed_shards():
+    yield
+    close_shard_files()
+
+
+def test_json_lines_can_be_read_again_by_offset(tmp_path):
+    json_path = str(tmp_path / "manifest.jsonl")
+
+    for index in range(3):
+        append_json_line(output_path=json_path, json_data={"tile_name": f"tile_{index}", "text": "ğüşiöç" * index})
+
+    # a line cut short by a killed run is skipped
+    with open(json_path, "a") as f:
+        f.write('{"tile_name": "tile_')
+
+    json_lines = list(iter_json_lines(json_path=json_path))
+
+    assert [json_data["tile_name"] for _, json_data in json_lines] == ["tile_0", "tile_1", "tile_2"]
+
+    for line_offset, json_data in json_lines:
+        assert load_json_line(json_path=json_path, line_offset=line_offset) == json_data
+
+
+@pytest.mark.parametrize("cut_line, expected_names", [
+    ('{"tile_name": "01-0-', ["01-0-0", "01-0-1", "01-0-2"]),
+    ('{"tile_name": "01-0-9"}', ["01-0-0", "01-0-9", "01-0-1", "01-0-2"]),
+])
+def test_json_lines_append_after_a_cut_line(tmp_path, cut_line, expected_names):
+    json_path = str(tmp_path / "manifest.jsonl")
+
+    append_json_line(output_path=json_path, json_data={"tile_name": "01-0-0"})
+
+    # the killed run wrote part of a line, or a whole record without its newline
+    with open(json_path, "a") as f:
+        f.write(cut_line)
+
+    repair_json_lines(json_path=json_path)
+
+    append_json_line(output_path=json_path, json_data={"tile_name": "01-0-1"})
+    append_json_line(output_path=json_path, json_data={"tile_name": "01-0-2"})
+
+    tile_names = [json_data["tile_name"] for _, json_data in iter_json_lines(json_path=json_path)]
+
+    assert tile_names == expected_names
+
+
+def test_json_lines_repair_of_an_empty_file(tmp_path):
+    json_path = tmp_path / "manifest.jsonl"
+    json_path.write_text('{"tile_na')
+
+    repair_json_lines(json_path=str(json_path))
+
+    assert json_path.read_bytes() == b""
+
+
+def test_shard_members_keep_their_signatures(tmp_path):
+    output_dir = str(tmp_path)
+    output_paths = [path.join(output_dir, "tile_0.png"), path.join(output_dir, "tile_0_seg.png")]
+
+    for output_path in output_paths:
+        with open(output_path, "wb") as f:
+            f.write(output_path.encode() * 100)
+
+    tile_result = {"tile_name": "tile_0", "width": 8, "height": 8, "annotations": [], "outputs": list(output_paths),
+                   "checksums": {output_path: file_checksum(file_path=output_path) for output_path in output_paths},
+                   "signatures": {output_path: file_signature(file_path=output_path) for output_path in output_paths}}
+    file_sizes = [path.getsize(output_path) for output_path in output_paths]
+
+    shard_writer = open_shard_writer(output_dir=output_dir, shard_prefix="scene", shard_size=10)
+    tile_result = write_shard_tile(shard_writer=shard_writer, tile_result=tile_result)
+    close_shard_writer(shard_writer=shard_writer)
+
+    assert sorted(tile_result["signatures"]) == sorted(tile_result["checksums"]) == sorted(tile_result["outputs"])
+
+    for member_path, file_size in zip(tile_result["outputs"], file_sizes):
+        assert not path.exists(path.join(output_dir, path.basename(member_path)))
+        assert get_output_signature(file_path=member_path) == tile_result["signatures"][member_path]
+        assert get_output_signature(file_path=member_path)[0] == file_size
+        assert get_output_checksum(file_path=member_path) == tile_result["checksums"][member_path]
+        assert len(read_shard_file(file_path=member_path)) == file_size
+
+    assert get_output_signature(file_path=path.join(output_dir, "scene_00000.tar", "missing.png")) is None
+
+
+def test_loose_file_signature(tmp_path):
+    output_path = str(tmp_path / "tile_0.png")
+
+    assert get_output_signature(file_path=output_path) is None
+
+    with open(output_path, "wb") as f:
+        f.write(b"png")
+
+    assert get_output_signature(file_path=output_path) == file_signature(file_path=output_path)
+    assert file_signature(file_path=output_path)[0] == 3
@@ -0,0 +1,160 @@
+"""
+Author: Resul Emre AYGAN
+"""
+
+from os import utime, stat
+
+import pytest
+
+pytest.importorskip("osgeo")
+
+import tile_operations  # noqa: E402
+from tile_operations import run_tile_pipeline, add_tile_checksums, append_tile_manifest  # noqa: E402
+from tile_operations import load_tile_manifest, load_manifest_tile  # noqa: E402
+from tile_operations import get_tile_offsets  # noqa: E402
+
+
+def write_tile_file(output_path, data, written_paths):
+    if data is None:
+        raise OSError(f"disk full - {output_path}")
+
+    written_paths.append(output_path)
+
+
+@pytest.fixture
+def fake_tile_stages(monkeypatch):
+    written_paths = []
+
+    def read_tile_job_raster(tile_job):
+        if tile_job["fail_stage"] == "read":
+            raise OSError(f"read failed - {tile_job['temp_file_name']}")
+
+        return tile_job["temp_file_name"]
+
+    def process_tile(temp_file_name, fail_stage, tile_raster, output_writer):
+        if fail_stage == "encode":
+            raise ValueError(f"encode failed - {temp_file_name}")
+
+        for file_index in range(3):
+            output_writer(write_tile_file, output_path=f"{temp_file_name}_{file_index}",
+                          data=None if fail_stage == "write" and file_index == 1 else b"",
+                          written_paths=written_paths)
+
+        return {"tile_name": temp_file_name, "tile_raster": tile_raster}
+
+    monkeypatch.setattr(tile_operations, "read_tile_job_raster", read_tile_job_raster)
+    monkeypatch.setattr(tile_operations, "process_tile", process_tile)
+    monkeypatch.setattr(tile_operations, "add_tile_checksums", lambda tile_result: tile_result)
+
+    return written_paths
+
+
+def create_tile_jobs(tile_count, fail_index=None, fail_stage=None):
+    return [{"temp_file_name": f"tile_{index}", "fail_stage": fail_stage if index == fail_index else None}
+            for index in range(tile_count)]
+
+
+@pytest.mark.parametrize("encoder_workers", [1, 3])
+def test_pipeline_keeps_tile_order(fake_tile_stages, encoder_workers):
+    tile_jobs = create_tile_jobs(tile_count=12)
+
+    tile_results = list(run_tile_pipeline(tile_jobs=tile_jobs, prefetch_queue_size=2, encoder_workers=encoder_workers,
+                                          write_queue_size=2))
+
+    assert [tile_result["tile_name"] for tile_result in tile_results] == [f"tile_{index}" for index in range(12)]
+    assert [tile_result["tile_raster"] for tile_result in tile_results] == [f"tile_{index}" for index in range(12)]
+    assert sorted(fake_tile_stages) == sorted(f"tile_{index}_{file_index}" for index in range(12)
+                                              for file_index in range(3))
+
+
+@pytest.mark.parametrize("fail_stage, error_type", [("read", OSError), ("encode", ValueError), ("write", OSError)])
+def test_pipeline_fails_the_tile_that_failed(fake_tile_stages, fail_stage, error_type):
+    tile_jobs = create_tile_jobs(tile_count=6, fail_index=3, fail_stage=fail_stage)
+    tile_results = run_tile_pipeline(tile_jobs=tile_jobs, prefetch_queue_size=2, encoder_workers=2, write_queue_size=2)
+
+    assert [next(tile_results)["tile_name"] for _ in range(3)] == ["tile_0", "tile_1", "tile_2"]
+
+    with pytest.raises(error_type, match="tile_3"):
+        next(tile_results)
+
+    # the files queued after the failed write are dropped
+    assert "tile_3_2" not in fake_tile_stages
+
+
+@pytest.fixture
+def manifest_tiles(tmp_path, monkeypatch):
+    manifest_path = str(tmp_path / "scene_manifest.jsonl")
+    output_paths = {}
+
+    for tile_name in ["tile_0", "tile_1", "tile_2"]:
+        output_paths[tile_name] = str(tmp_path / f"{tile_name}.png")
+
+        with open(output_paths[tile_name], "wb") as f:
+            f.write(tile_name.encode() * 10)
+
+        tile_result = add_tile_checksums(tile_result={"tile_name": tile_name, "outputs": [output_paths[tile_name]],
+                                                      "annotations": [{"id": 1, "segmentation": [[0, 0, 1, 1]]}]})
+        append_tile_manifest(manifest_path=manifest_path, tile_result=tile_result)
+
+    hashed_paths = []
+    get_output_checksum = tile_operations.get_output_checksum
+
+    def count_output_checksum(file_path):
+        hashed_paths.append(file_path)
+        return get_output_checksum(file_path=file_path)
+
+    monkeypatch.setattr(tile_operations, "get_output_checksum", count_output_checksum)
+
+    return manifest_path, output_paths, hashed_paths
+
+
+def test_manifest_keeps_unchanged_tiles_without_hashing(manifest_tiles):
+    manifest_path, output_paths, hashed_paths = manifest_tiles
+
+    completed_tiles = load_tile_manifest(manifest_path=manifest_path)
+
+    assert sorted(completed_tiles) == ["tile_0", "tile_1", "tile_2"]
+    assert hashed_paths == []
+    assert all("annotations" not in manifest_tile for manifest_tile in completed_tiles.values())
+
+    tile_result = load_manifest_tile(manifest_path=manifest_path, manifest_tile=completed_tiles["tile_1"])
+
+    assert tile_result["tile_name"] == "tile_1"
+    assert tile_result["annotations"] == [{"id": 1, "segmentation": [[0, 0, 1, 1]]}]
+
+
+def test_manifest_hashes_only_touched_outputs(manifest_tiles):
+    manifest_path, output_paths, hashed_paths = manifest_tiles
+
+    # tile_0 is touched but unchanged, tile_1 is rewritten with the same size, tile_2 is removed
+    output_stat = stat(output_paths["tile_0"])
+    utime(output_paths["tile_0"], ns=(output_stat.st_atime_ns, output_stat.st_mtime_ns + 10 ** 9))
+
+    with open(output_paths["tile_1"], "wb") as f:
+        f.write(b"x" * len(b"tile_1" * 10))
+
+    output_stat = stat(output_paths["tile_1"])
+    utime(output_paths["tile_1"], ns=(output_stat.st_atime_ns, output_stat.st_mtime_ns + 10 ** 9))
+
+    tile_operations.delete_file(file_path=output_paths["tile_2"])
+
+    completed_tiles = load_tile_manifest(manifest_path=manifest_path)
+
+    assert sorted(completed_tiles) == ["tile_0"]
+    assert sorted(hashed_paths) == [output_paths["tile_0"], output_paths["tile_1"]]
+
+
+@pytest.mark.parametrize("size, crop_size, tile_overlap, tile_edge_mode, tile_offsets", [
+    (1024, 512, 0, "pad", [0, 512]),
+    (1000, 512, 0, "pad", [0, 512]),
+    (1024, 512, 128, "pad", [0, 384, 768]),
+    # the last tile starts past size - crop_size and is padded
+    (1000, 512, 128, "pad", [0, 384, 768]),
+    (1000, 512, 128, "shift", [0, 384, 488]),
+    (1024, 512, 128, "shift", [0, 384, 512]),
+    # a raster smaller than one tile is never shifted to a negative offset
+    (300, 512, 128, "shift", [0]),
+])
+def test_tile_offsets(size, crop_size, tile_overlap, tile_edge_mode, tile_offsets):
+    assert get_tile_offsets(size=size, crop_size=crop_size, tile_overlap=tile_overlap,
+                            tile_edge_mode=tile_edge_mode) == tile_offsets
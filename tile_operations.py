@@ -0,0 +1,716 @@
+"""
+Author: Resul Emre AYGAN
+"""
+
+from concurrent.futures import ProcessPoolExecutor, Future, InvalidStateError
+from datetime import datetime
+from functools import partial
+from math import ceil
+from os import path
+from queue import Queue
+from threading import Thread
+
+import numpy as np
+
+from coco_operations import model_class, create_label_annotations, create_component_annotations, \
+    create_vector_annotations, scale_annotations, get_category_masks
+from geometry_operations import bounds_to_polygon, transform_polygon_osr, save_gdf_to_shapefile, get_vector_index, \
+    clip_gdf_with_polygon, geometries_to_pixel
+from raster_operations import change_raster_projection, crop_raster_with_warp, crop_raster_with_translate, \
+    get_array_from_raster, encode_raster_as_png, get_array_from_raster_window, save_array_as_raster, \
+    rasterize_geometries, label_to_rgb_mask, is_raster_window_empty, close_raster, rasterize_instances, \
+    get_array_from_raster_overview, downsample_raster
+from utils.file_operations import delete_file, generate_temp_file_path, file_exists, file_checksum, append_json_line, \
+    iter_json_lines, repair_json_lines, write_bytes, file_signature, load_json_line
+from utils.metric_operations import profile_stage, add_counter, take_metrics, reset_metrics, profile_stages
+from utils.shard_operations import get_output_checksum, get_output_signature
+
+
+@profile_stage(stage_name="prepare")
+def prepare_scene_tile_jobs(scene_index, raster_path, output_dir, crop_size_x, crop_size_y, virtual_reprojection,
+                            skip_empty_tiles, skip_tiles_without_features, tile_overlap=0, tile_edge_mode="pad",
+                            **tile_params):
+    scene = {"tile_jobs": [], "skipped_counts": {"empty": 0, "without_features": 0}, "temp_raster_path": None,
+             "mosaic": None}
+
+    if not file_exists(file_path=raster_path):
+        print(f"Raster bulunamadi! - {raster_path}")
+        return scene
+
+    [geo_transform, x_min, y_max, res_x, res_y, width, height, epsg, geom_poly] = get_array_from_raster(
+        file_path=raster_path)
+    #
+    # crop_size_x = min(width, crop_size_x)
+    # crop_size_y = min(height, crop_size_x)
+
+    generate_alpha = False
+
+    if epsg != 4326:
+        print(f"Raster EPSG:4326 formatinda degil, donusturuluyor. - {raster_path}")
+        generate_alpha = True
+
+        raster_path_4326 = generate_temp_file_path(output_path=output_dir,
+                                                   file_ext='vrt' if virtual_reprojection else 'tif')
+
+        if not change_raster_projection(raster_path=path.abspath(raster_path), output_path=raster_path_4326,
+                                        src_epsg=epsg, dst_epsg=4326,
+                                        output_format='VRT' if virtual_reprojection else 'GTiff'):
+            return scene
+
+        scene["temp_raster_path"] = raster_path_4326
+
+        [geo_transform, x_min, y_max, res_x, res_y, width, height, epsg, geom_poly] = get_array_from_raster(
+            file_path=raster_path_4326)
+        raster_path = raster_path_4326
+
+    x_steps = [(x_min + x_offset * res_x, x_min + (x_offset + crop_size_x) * res_x)
+               for x_offset in get_tile_offsets(size=width, crop_size=crop_size_x, tile_overlap=tile_overlap,
+                                                tile_edge_mode=tile_edge_mode)]
+    y_steps = [(y_max - y_offset * abs(res_y), y_max - (y_offset + crop_size_y) * abs(res_y))
+               for y_offset in get_tile_offsets(size=height, crop_size=crop_size_y, tile_overlap=tile_overlap,
+                                                tile_edge_mode=tile_edge_mode)]
+
+    # the tile grid is pixel aligned, a mosaic over the same bounds holds every tile at a fixed window
+    scene["mosaic"] = {"raster_path": raster_path,
+                       "output_bounds": (x_steps[0][0], y_steps[0][0], x_steps[-1][1], y_steps[-1][1]),
+                       "res_x": res_x, "res_y": res_y}
+
+    tile_jobs = generate_tile_jobs(x_steps=x_steps, y_steps=y_steps, scene_index=scene_index, raster_path=raster_path,
+                                   output_dir=output_dir, res_x=res_x, res_y=res_y, epsg=epsg,
+                                   generate_alpha=generate_alpha, **tile_params)
+
+    scene["tile_jobs"], scene["skipped_counts"] = filter_tile_jobs(
+        tile_jobs=tile_jobs, raster_path=raster_path, shape_path=tile_params["shape_path"],
+        skip_empty_tiles=skip_empty_tiles and not tile_params["use_warp"],
+        skip_tiles_without_features=skip_tiles_without_features and tile_params["crop_shape"])
+
+    return scene
+
+
+def get_tile_offsets(size, crop_size, tile_overlap=0, tile_edge_mode="pad"):
+    tile_stride = crop_size - tile_overlap
+
+    # the fewest tiles whose last one reaches the raster edge, without overlap this is ceil(size / crop_size)
+    tile_offsets = [tile_stride * i for i in range(max(1, ceil((size - tile_overlap) / tile_stride)))]
+
+    # shift moves the last tile back inside the raster instead of padding it past the edge
+    if tile_edge_mode == "shift" and size > crop_size:
+        tile_offsets[-1] = size - crop_size
+
+    return tile_offsets
+
+
+def get_tile_geo_transform(tile_job):
+    return (tile_job["temp_x_min"], tile_job["res_x"], 0.0, tile_job["temp_y_max"], 0.0, -abs(tile_job["res_y"]))
+
+
+def generate_tile_jobs(x_steps, y_steps, scene_index=1, **tile_params):
+    tile_jobs = []
+
+    for i, (temp_x_min, temp_x_max) in enumerate(x_steps):
+        for j, (temp_y_max, temp_y_min) in enumerate(y_steps):
+            tile_jobs.append({
+                "temp_file_name": f'{scene_index:02d}' + "-" + str(j) + "-" + str(i),
+                "temp_x_min": temp_x_min,
+                "temp_x_max": temp_x_max,
+                "temp_y_max": temp_y_max,
+                "temp_y_min": temp_y_min,
+                **tile_params
+            })
+
+    return tile_jobs
+
+
+def filter_tile_jobs(tile_jobs, raster_path, shape_path, skip_empty_tiles, skip_tiles_without_features):
+    kept_jobs = []
+    skipped_counts = {"empty": 0, "without_features": 0}
+
+    if skip_tiles_without_features:
+        _, vector_index = get_vector_index(shapefile_path=shape_path)
+
+    for tile_job in tile_jobs:
+        if skip_empty_tiles and is_raster_window_empty(file_path=raster_path,
+                                                       output_bounds=(tile_job["temp_x_min"], tile_job["temp_y_max"],
+                                                                      tile_job["temp_x_max"], tile_job["temp_y_min"])):
+            print(f"Parca bos/nodata oldugu icin atlandi. {tile_job['temp_file_name']}")
+            skipped_counts["empty"] += 1
+            continue
+
+        if skip_tiles_without_features:
+            tile_polygon = bounds_to_polygon(geom_bounds=(tile_job["temp_x_min"], tile_job["temp_y_min"],
+                                                          tile_job["temp_x_max"], tile_job["temp_y_max"]))
+
+            if len(vector_index.query(tile_polygon, predicate='intersects')) == 0:
+                print(f"Parca vektor icermedigi icin atlandi. {tile_job['temp_file_name']}")
+                skipped_counts["without_features"] += 1
+                continue
+
+        kept_jobs.append(tile_job)
+
+    return kept_jobs, skipped_counts
+
+
+@profile_stage(stage_name="tile_read")
+def read_tile_raster(temp_file_name, temp_x_min, temp_x_max, temp_y_min, temp_y_max, raster_path, output_dir, res_x,
+                     res_y, epsg, raster_format, use_warp, window_read, save_tile_raster, reuse_buffer=False,
+                     raster_profile="plain", raster_compression="NONE", pyramid_levels=(1,)):
+    tile_raster = {"outputs": []}
+
+    temp_output_path = generate_temp_file_path(output_path=output_dir, file_name=temp_file_name, file_ext='tif')
+
+    temp_bounds = (abs(temp_x_min), abs(temp_y_max), abs(temp_x_max), abs(temp_y_min))
+
+    if use_warp:
+        temp_polygon = bounds_to_polygon(geom_bounds=temp_bounds)
+        transformed_poly = transform_polygon_osr(polygon=temp_polygon, src_epsg=epsg, dst_epsg=4326)
+        temp_bounds = transformed_poly.bounds
+
+        _ = crop_raster_with_warp(raster_path=raster_path, output_bounds=temp_bounds,
+                                  output_path=temp_output_path, epsg_number=4326, multi=True, num_thread=-9999)
+
+        [original_raster, alpha_channel, geo_transform, min_x, max_y, res_x, res_y, width, height,
+         epsg, geom_poly] = get_array_from_raster(file_path=temp_output_path, only_info=False)
+
+        close_raster(file_path=temp_output_path)
+    elif window_read:
+        [original_raster, alpha_channel, geo_transform, min_x, max_y, res_x, res_y, width, height,
+         epsg, geom_poly] = get_array_from_raster_window(file_path=raster_path,
+                                                         output_bounds=(temp_x_min, temp_y_max, temp_x_max,
+                                                                        temp_y_min),
+                                                         reuse_buffer=reuse_buffer)
+    else:
+        crop_raster_with_translate(raster_path=raster_path, output_path=temp_output_path,
+                                   res_x=res_x, res_y=res_y, output_bounds=temp_bounds,
+                                   raster_format=raster_format, raster_profile=raster_profile,
+                                   raster_compression=raster_compression)
+
+        [original_raster, alpha_channel, geo_transform, min_x, max_y, res_x, res_y, width, height,
+         epsg, geom_poly] = get_array_from_raster(file_path=temp_output_path, only_info=False)
+
+        # the tile file is only read once, its handle is not kept in the raster cache
+        close_raster(file_path=temp_output_path)
+
+        if not save_tile_raster:
+            delete_file(file_path=temp_output_path)
+        else:
+            tile_raster["outputs"].append(temp_output_path)
+
+    tile_raster.update({"original_raster": original_raster, "alpha_channel": alpha_channel,
+                        "geo_transform": geo_transform, "res_x": res_x, "res_y": res_y, "width": width,
+                        "height": height, "epsg": epsg, "geom_poly": geom_poly, "level_rasters": {}})
+
+    # pyramid levels of a window tile are read here as well, GDAL handles are only used by the reading thread
+    if window_read and not use_warp:
+        for pyramid_level in pyramid_levels:
+            if pyramid_level != 1:
+                tile_raster["level_rasters"][pyramid_level] = get_array_from_raster_overview(
+                    file_path=raster_path, output_bounds=(temp_x_min, temp_y_max, temp_x_max, temp_y_min),
+                    factor=pyramid_level)
+
+    return tile_raster
+
+
+def read_tile_job_raster(tile_job):
+    return read_tile_raster(temp_file_name=tile_job["temp_file_name"], temp_x_min=tile_job["temp_x_min"],
+                            temp_x_max=tile_job["temp_x_max"], temp_y_min=tile_job["temp_y_min"],
+                            temp_y_max=tile_job["temp_y_max"], raster_path=tile_job["raster_path"],
+                            output_dir=tile_job["output_dir"], res_x=tile_job["res_x"], res_y=tile_job["res_y"],
+                            epsg=tile_job["epsg"], raster_format=tile_job["raster_format"],
+                            use_warp=tile_job["use_warp"], window_read=tile_job["window_read"],
+                            save_tile_raster=tile_job["save_tile_raster"], raster_profile=tile_job["raster_profile"],
+                            raster_compression=tile_job["raster_compression"],
+                            pyramid_levels=tile_job["pyramid_levels"])
+
+
+def write_output(write_function, **write_params):
+    write_function(**write_params)
+
+
+@profile_stage(stage_name="tile")
+def process_tile(temp_file_name, temp_x_min, temp_x_max, temp_y_min, temp_y_max, raster_path, output_dir, res_x,
+                 res_y, epsg, raster_format, use_warp, window_read, save_tile_raster, save_as_png, generate_alpha,
+                 crop_shape, shape_path, seg_mask, seg_mask_as_png, convert_coco, categories_dict, png_backend="pil",
+                 png_compression=6, annotation_engine="contours", raster_profile="plain", raster_compression="NONE",
+                 pyramid_levels=(1,), tile_raster=None, output_writer=write_output):
+    tile_result = {"tile_name": temp_file_name, "image_list": [], "seg_list": [], "categories_seg_list": [],
+                   "annotations": [], "outputs": [], "width": 0, "height": 0}
+
+    add_counter(counter_name="tiles")
+
+    # tile_raster is passed in when a reader stage has already prefetched the window, otherwise the tile is read
+    # into the reused buffer since every write below finishes before the next tile is read
+    if tile_raster is None:
+        tile_raster = read_tile_raster(temp_file_name=temp_file_name, temp_x_min=temp_x_min, temp_x_max=temp_x_max,
+                                       temp_y_min=temp_y_min, temp_y_max=temp_y_max, raster_path=raster_path,
+                                       output_dir=output_dir, res_x=res_x, res_y=res_y, epsg=epsg,
+                                       raster_format=raster_format, use_warp=use_warp, window_read=window_read,
+                                       save_tile_raster=save_tile_raster,
+                                       reuse_buffer=output_writer is write_output, raster_profile=raster_profile,
+                                       raster_compression=raster_compression, pyramid_levels=pyramid_levels)
+
+    original_raster = tile_raster["original_raster"]
+    alpha_channel = tile_raster["alpha_channel"]
+    geo_transform = tile_raster["geo_transform"]
+    width = tile_raster["width"]
+    height = tile_raster["height"]
+    epsg = tile_raster["epsg"]
+    geom_poly = tile_raster["geom_poly"]
+
+    tile_result["outputs"].extend(tile_raster["outputs"])
+
+    temp_output_path = generate_temp_file_path(output_path=output_dir, file_name=temp_file_name, file_ext='tif')
+    temp_output_path_png = generate_temp_file_path(output_path=output_dir,
+                                                   file_name=temp_file_name,
+                                                   file_ext='png')
+
+    if window_read and not use_warp and save_tile_raster:
+        output_writer(save_array_as_raster, raster_array=original_raster, alpha_channel=alpha_channel,
+                      output_path=temp_output_path, geo_transform=geo_transform, epsg=epsg,
+                      raster_format=raster_format, raster_profile=raster_profile,
+                      raster_compression=raster_compression)
+        tile_result["outputs"].append(temp_output_path)
+
+    tile_result["width"] = width
+    tile_result["height"] = height
+
+    if save_as_png:
+        output_writer(write_bytes, output_path=temp_output_path_png,
+                      data=encode_raster_as_png(raster_array=original_raster, alpha_channel=alpha_channel,
+                                                generate_alpha=generate_alpha, png_backend=png_backend,
+                                                png_compression=png_compression))
+        tile_result["image_list"].append(temp_output_path_png)
+        tile_result["outputs"].append(temp_output_path_png)
+    else:
+        tile_result["image_list"].append(temp_output_path)
+
+    label_array, category_names = None, []
+
+    if crop_shape:
+        label_array, category_names = create_tile_labels(
+            temp_file_name=temp_file_name, output_dir=output_dir, geo_transform=geo_transform, width=width,
+            height=height, epsg=epsg, geom_poly=geom_poly, shape_path=shape_path, seg_mask=seg_mask,
+            seg_mask_as_png=seg_mask_as_png, convert_coco=convert_coco, categories_dict=categories_dict,
+            tile_result=tile_result, png_backend=png_backend, png_compression=png_compression,
+            annotation_engine=annotation_engine, raster_profile=raster_profile, raster_compression=raster_compression,
+            output_writer=output_writer)
+
+    if len(pyramid_levels) > 1:
+        add_pyramid_levels(tile_result=tile_result, tile_raster=tile_raster, label_array=label_array,
+                           category_names=category_names, pyramid_levels=pyramid_levels,
+                           temp_file_name=temp_file_name, output_dir=output_dir, raster_format=raster_format,
+                           save_tile_raster=save_tile_raster, save_as_png=save_as_png,
+                           generate_alpha=generate_alpha, seg_mask=seg_mask, seg_mask_as_png=seg_mask_as_png,
+                           categories_dict=categories_dict, png_backend=png_backend, png_compression=png_compression,
+                           annotation_engine=annotation_engine, raster_profile=raster_profile,
+                           raster_compression=raster_compression, output_writer=output_writer)
+
+    return tile_result
+
+
+def create_tile_labels(temp_file_name, output_dir, geo_transform, width, height, epsg, geom_poly, shape_path, seg_mask,
+                       seg_mask_as_png, convert_coco, categories_dict, tile_result, png_backend="pil",
+                       png_compression=6, annotation_engine="contours", raster_profile="plain",
+                       raster_compression="NONE", output_writer=write_output):
+    crop_shape_path = generate_temp_file_path(output_path=output_dir,
+                                              file_name=temp_file_name,
+                                              file_ext='shp')
+
+    vector_data, vector_index = get_vector_index(shapefile_path=shape_path)
+    data = clip_gdf_with_polygon(gdf_data=vector_data, spatial_index=vector_index, polygon=geom_poly)
+
+    output_writer(save_gdf_to_shapefile, output_path=crop_shape_path, epsg=epsg, gdf_data=data, allow_empty=True)
+    tile_result["outputs"].append(crop_shape_path)
+
+    if not seg_mask and not convert_coco:
+        return None, []
+
+    split_categories = (not len(categories_dict) == 1 and 'buildings' in categories_dict.keys() and
+                        'damage_gra' in data.keys())
+
+    if split_categories:
+        category_names = [model_class.get(damage_gra_val, model_class[""]) for damage_gra_val in data['damage_gra']]
+        burn_values = [categories_dict[category_name]['id'] for category_name in category_names]
+    else:
+        category_names = []
+        burn_values = [255] * len(data)
+
+    category_names = list(dict.fromkeys(category_names))
+
+    if split_categories:
+        feature_categories = burn_values
+    elif 'buildings' in categories_dict.keys():
+        feature_categories = [categories_dict['buildings']['id']] * len(data)
+    else:
+        feature_categories = [0] * len(data)
+
+    if convert_coco and annotation_engine == "vectors":
+        # the clipped footprints are moved into tile pixels with the tile geotransform, nothing is rasterized
+        _, tile_result["annotations"] = create_vector_annotations(
+            geometries=geometries_to_pixel(geometries=data.geometry.values, geo_transform=geo_transform),
+            category_ids=feature_categories, image_id=0, is_crowd=False)
+
+        if not seg_mask:
+            return None, category_names
+
+    use_components = convert_coco and annotation_engine == "components"
+
+    if use_components:
+        # footprints are burnt with their own index so touching buildings stay separate, the category raster is
+        # a lookup on it since the last footprint wins a pixel in both rasters
+        instance_array = rasterize_instances(geometries=data.geometry.values, geo_transform=geo_transform,
+                                             width=width, height=height, epsg=epsg)
+
+        if instance_array is None:
+            return None, category_names
+
+        label_array = np.asarray([0] + burn_values, dtype=np.uint8)[instance_array]
+    else:
+        # every category is burnt into one label raster, the masks below are derived from it
+        label_array = rasterize_geometries(geometries=data.geometry.values, burn_values=burn_values,
+                                           geo_transform=geo_transform, width=width, height=height, epsg=epsg)
+
+        if label_array is None:
+            return None, category_names
+
+    if seg_mask:
+        save_tile_seg_masks(label_array=label_array, category_names=category_names, temp_file_name=temp_file_name,
+                            output_dir=output_dir, geo_transform=geo_transform, epsg=epsg,
+                            seg_mask_as_png=seg_mask_as_png, categories_dict=categories_dict, tile_result=tile_result,
+                            png_backend=png_backend, png_compression=png_compression,
+                            raster_profile=raster_profile, raster_compression=raster_compression,
+                            output_writer=output_writer)
+
+    if use_components:
+        _, tile_result["annotations"] = create_component_annotations(instance_array=instance_array,
+                                                                     instance_categories=[0] + feature_categories,
+                                                                     image_id=0, is_crowd=False)
+    elif convert_coco and annotation_engine == "contours":
+        category_masks = get_category_masks(label_array=label_array, category_names=category_names,
+                                            categories=categories_dict)
+
+        # ids are local to the tile, write_coco_stream_tile renumbers them as the tile is streamed
+        _, tile_result["annotations"] = create_label_annotations(category_masks=category_masks, image_id=0,
+                                                                 is_crowd=False, categories=categories_dict)
+
+    return label_array, category_names
+
+
+def add_pyramid_levels(tile_result, tile_raster, label_array, category_names, pyramid_levels, temp_file_name,
+                       output_dir, raster_format, save_tile_raster, save_as_png, generate_alpha, seg_mask,
+                       seg_mask_as_png, categories_dict, png_backend="pil", png_compression=6,
+                       annotation_engine="contours", raster_profile="plain", raster_compression="NONE",
+                       output_writer=write_output):
+    tile_result["levels"] = {}
+
+    # every level reuses the base tile's annotations, source_id ties the copies together across the COCO files
+    for annotation_index, annotation in enumerate(tile_result["annotations"]):
+        annotation["source_id"] = f'{temp_file_name}/{annotation_index}'
+
+    # traced contours are in pixel centers, vector annotations in pixel corners
+    pixel_offset = 0.0 if annotation_engine == "vectors" else 0.5
+
+    geo_transform = tile_raster["geo_transform"]
+
+    for pyramid_level in pyramid_levels:
+        if pyramid_level == 1:
+            continue
+
+        level_name = f'{temp_file_name}_x{pyramid_level}'
+        level_result = {"image_list": [], "seg_list": [], "categories_seg_list": [], "outputs": []}
+
+        # sources with overviews were read at this level by the reader, the others are averaged from the base tile
+        level_raster = tile_raster["level_rasters"].get(pyramid_level)
+
+        if level_raster is None:
+            level_raster = (downsample_raster(raster_array=tile_raster["original_raster"], factor=pyramid_level),
+                            None if tile_raster["alpha_channel"] is None else
+                            downsample_raster(raster_array=tile_raster["alpha_channel"], factor=pyramid_level))
+
+        original_raster, alpha_channel = level_raster
+        level_height, level_width = original_raster.shape[:2]
+        level_geo_transform = (geo_transform[0], geo_transform[1] * pyramid_level, geo_transform[2],
+                               geo_transform[3], geo_transform[4], geo_transform[5] * pyramid_level)
+
+        level_output_path = generate_temp_file_path(output_path=output_dir, file_name=level_name, file_ext='tif')
+        level_output_path_png = generate_temp_file_path(output_path=output_dir, file_name=level_name, file_ext='png')
+
+        if save_tile_raster:
+            output_writer(save_array_as_raster, raster_array=original_raster, alpha_channel=alpha_channel,
+                          output_path=level_output_path, geo_transform=level_geo_transform, epsg=tile_raster["epsg"],
+                          raster_format=raster_format, raster_profile=raster_profile,
+                          raster_compression=raster_compression)
+            level_result["outputs"].append(level_output_path)
+
+        if save_as_png:
+            output_writer(write_bytes, output_path=level_output_path_png,
+                          data=encode_raster_as_png(raster_array=original_raster, alpha_channel=alpha_channel,
+                                                    generate_alpha=generate_alpha, png_backend=png_backend,
+                                                    png_compression=png_compression))
+            level_result["image_list"].append(level_output_path_png)
+            level_result["outputs"].append(level_output_path_png)
+        else:
+            level_result["image_list"].append(level_output_path)
+
+        level_result["width"] = level_width
+        level_result["height"] = level_height
+        level_result["annotations"] = scale_annotations(annotations=tile_result["annotations"], factor=pyramid_level,
+                                                        pixel_offset=pixel_offset)
+
+        if seg_mask and label_array is not None:
+            # the base label raster is sampled at the block centers, nothing is clipped or rasterized again
+            level_labels = label_array[pyramid_level // 2::pyramid_level, pyramid_level // 2::pyramid_level]
+
+            save_tile_seg_masks(label_array=np.ascontiguousarray(level_labels[:level_height, :level_width]),
+                                category_names=category_names, temp_file_name=level_name, output_dir=output_dir,
+                                geo_transform=level_geo_transform, epsg=tile_raster["epsg"],
+                                seg_mask_as_png=seg_mask_as_png, categories_dict=categories_dict,
+                                tile_result=level_result, png_backend=png_backend, png_compression=png_compression,
+                                raster_profile=raster_profile, raster_compression=raster_compression,
+                                output_writer=output_writer)
+
+        tile_result["outputs"].extend(level_result.pop("outputs"))
+        tile_result["levels"][str(pyramid_level)] = level_result
+
+
+def save_tile_seg_masks(label_array, category_names, temp_file_name, output_dir, geo_transform, epsg,
+                        seg_mask_as_png, categories_dict, tile_result, png_backend="pil", png_compression=6,
+                        raster_profile="plain", raster_compression="NONE", output_writer=write_output):
+    seg_mask_path = generate_temp_file_path(output_path=output_dir,
+                                            file_name=temp_file_name + "_seg",
+                                            file_ext='tif')
+    seg_mask_png_path = generate_temp_file_path(output_path=output_dir,
+                                                file_name=temp_file_name + "_seg",
+                                                file_ext='png')
+
+    for category_name in category_names:
+        categories_mask_path = generate_temp_file_path(
+            output_path=output_dir, file_name=f'{temp_file_name}_{category_name}_seg',
+            file_ext='tif')
+        categories_mask_png_path = generate_temp_file_path(
+            output_path=output_dir, file_name=f'{temp_file_name}_{category_name}_seg',
+            file_ext='png')
+
+        print(f'Kategorinin segmentation mask dosyasi olusturuluyor. {categories_mask_path} - '
+              f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
+
+        categories_mask = label_to_rgb_mask(label_array=label_array,
+                                            label_value=categories_dict[category_name]['id'],
+                                            rgb=categories_dict[category_name]['rgb'])
+
+        # mask overviews keep their label values, averaging would blur the category edges
+        output_writer(save_array_as_raster, raster_array=categories_mask, output_path=categories_mask_path,
+                      geo_transform=geo_transform, epsg=epsg, raster_format='GTiff', raster_profile=raster_profile,
+                      raster_compression=raster_compression, overview_resampling='NEAREST')
+        tile_result["outputs"].append(categories_mask_path)
+
+        if seg_mask_as_png:
+            print(
+                f'Kategorinin segmentation png dosyasi olusturuluyor. '
+                f'{categories_mask_png_path} - '
+                f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
+
+            output_writer(write_bytes, output_path=categories_mask_png_path,
+                          data=encode_raster_as_png(raster_array=categories_mask, generate_alpha=False,
+                                                    png_backend=png_backend, png_compression=png_compression))
+            tile_result["outputs"].append(categories_mask_png_path)
+
+            tile_result["categories_seg_list"].append(categories_mask_png_path)
+        else:
+            tile_result["categories_seg_list"].append(categories_mask_path)
+
+    seg_mask_array = ((label_array > 0) * np.uint8(255))[:, :, np.newaxis]
+
+    output_writer(save_array_as_raster, raster_array=seg_mask_array, output_path=seg_mask_path,
+                  geo_transform=geo_transform, epsg=epsg, raster_format='GTiff', raster_profile=raster_profile,
+                  raster_compression=raster_compression, overview_resampling='NEAREST')
+    tile_result["outputs"].append(seg_mask_path)
+
+    if seg_mask_as_png:
+        print(f'Raster\'a ait tum segmantation png dosyasi olusturuluyor. {seg_mask_png_path} - '
+              f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
+
+        output_writer(write_bytes, output_path=seg_mask_png_path,
+                      data=encode_raster_as_png(raster_array=seg_mask_array, generate_alpha=False,
+                                                png_backend=png_backend, png_compression=png_compression))
+        tile_result["outputs"].append(seg_mask_png_path)
+
+        if not category_names:
+            tile_result["seg_list"].append(seg_mask_png_path)
+    else:
+        if not category_names:
+            tile_result["seg_list"].append(seg_mask_path)
+
+
+def add_tile_checksums(tile_result):
+    tile_result["checksums"] = {output_path: file_checksum(file_path=output_path)
+                                for output_path in tile_result["outputs"] if file_exists(file_path=output_path)}
+
+    # size and mtime let a resumed run skip hashing the outputs nobody touched
+    tile_result["signatures"] = {output_path: file_signature(file_path=output_path)
+                                 for output_path in tile_result["checksums"]}
+
+    return tile_result
+
+
+def run_tile_job(tile_job):
+    tile_result = process_tile(**tile_job)
+
+    # checksums are taken in the worker so resume checks stay off the main process
+    tile_result = add_tile_checksums(tile_result=tile_result)
+
+    # pool workers hand their timings and profiles back with every result and the main process merges them
+    tile_result["metrics"] = take_metrics()
+
+    return tile_result
+
+
+def append_tile_manifest(manifest_path, tile_result):
+    append_json_line(output_path=manifest_path, json_data=tile_result)
+
+
+def is_tile_output_unchanged(output_path, checksum, signature=None):
+    output_signature = get_output_signature(file_path=output_path)
+
+    if output_signature is None:
+        return False
+
+    # an output with the size and mtime it was written with is not hashed again, a new size is a change for sure
+    if signature is not None:
+        if output_signature == signature:
+            return True
+
+        if output_signature[0] != signature[0]:
+            return False
+
+    return get_output_checksum(file_path=output_path) == checksum
+
+
+def load_tile_manifest(manifest_path):
+    completed_tiles = {}
+
+    if not file_exists(file_path=manifest_path):
+        return completed_tiles
+
+    # the resumed run appends to this manifest, a line cut short by the previous run is dropped first
+    repair_json_lines(json_path=manifest_path)
+
+    # annotations are not kept, load_manifest_tile reads a tile's line again when the grid reaches it
+    for line_offset, tile_result in iter_json_lines(json_path=manifest_path):
+        completed_tiles[tile_result["tile_name"]] = {"line_offset": line_offset,
+                                                     "levels": list(tile_result.get("levels", {})),
+                                                     "checksums": tile_result["checksums"],
+                                                     "signatures": tile_result.get("signatures", {})}
+
+    # a tile is only skipped if every output it wrote is still on disk unchanged
+    for tile_name, manifest_tile in list(completed_tiles.items()):
+        for output_path, checksum in manifest_tile["checksums"].items():
+            if not is_tile_output_unchanged(output_path=output_path, checksum=checksum,
+                                            signature=manifest_tile["signatures"].get(output_path)):
+                print(f"Parca ciktisi degismis, parca yeniden islenecek. {output_path}")
+                del completed_tiles[tile_name]
+                break
+
+    return completed_tiles
+
+
+def load_manifest_tile(manifest_path, manifest_tile):
+    return load_json_line(json_path=manifest_path, line_offset=manifest_tile["line_offset"])
+
+
+def run_tile_jobs(tile_jobs, num_workers=1):
+    # results are yielded one by one so finished tiles can be written out without keeping the whole run in memory
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=reset_metrics,
+                                 initargs=(tuple(profile_stages),)) as executor:
+            # map keeps the submission order, so the outputs match a serial run
+            yield from executor.map(run_tile_job, tile_jobs)
+    else:
+        for tile_job in tile_jobs:
+            yield run_tile_job(tile_job=tile_job)
+
+
+def finish_tile(tile_future, tile_result):
+    tile_future.set_result(add_tile_checksums(tile_result=tile_result))
+
+
+def fail_tile(tile_future, error):
+    # a tile can fail in its encoder and in the writer, only the first error is kept
+    try:
+        tile_future.set_exception(error)
+    except InvalidStateError:
+        pass
+
+
+def run_tile_pipeline(tile_jobs, prefetch_queue_size=4, encoder_workers=2, write_queue_size=16):
+    # reader -> encoders -> writer, the bounded queues keep at most a few tiles in memory at once
+    read_queue = Queue(maxsize=prefetch_queue_size)
+    write_queue = Queue(maxsize=write_queue_size)
+    tile_futures = [Future() for _ in tile_jobs]
+
+    def read_stage():
+        for index, tile_job in enumerate(tile_jobs):
+            try:
+                read_queue.put((index, tile_job, read_tile_job_raster(tile_job=tile_job)))
+            except Exception as error:
+                fail_tile(tile_future=tile_futures[index], error=error)
+
+        for _ in range(encoder_workers):
+            read_queue.put(None)
+
+    def queue_output(index, write_function, **write_params):
+        write_queue.put((index, write_function, write_params))
+
+    def encode_stage():
+        while True:
+            read_item = read_queue.get()
+
+            if read_item is None:
+                write_queue.put(None)
+                break
+
+            index, tile_job, tile_raster = read_item
+
+            # every queued write carries the tile's index, so a failed write fails that tile
+            try:
+                tile_result = process_tile(**tile_job, tile_raster=tile_raster,
+                                           output_writer=partial(queue_output, index))
+            except Exception as error:
+                fail_tile(tile_future=tile_futures[index], error=error)
+                continue
+
+            # queued after the tile's own writes, so its checksums are taken once every file is on disk
+            queue_output(index, finish_tile, tile_future=tile_futures[index], tile_result=tile_result)
+
+    def write_stage():
+        finished_encoders = 0
+
+        while finished_encoders < encoder_workers:
+            write_item = write_queue.get()
+
+            if write_item is None:
+                finished_encoders += 1
+                continue
+
+            index, write_function, write_params = write_item
+
+            # the rest of a failed tile's files are not written
+            if tile_futures[index].done():
+                continue
+
+            try:
+                write_function(**write_params)
+            except Exception as error:
+                print(f"Dosya yazilirken hata olustu: {error}")
+                fail_tile(tile_future=tile_futures[index], error=error)
+
+    stage_threads = [Thread(target=read_stage, daemon=True), Thread(target=write_stage, daemon=True)]
+    stage_threads += [Thread(target=encode_stage, daemon=True) for _ in range(encoder_workers)]
+
+    for stage_thread in stage_threads:
+        stage_thread.start()
+
+    for tile_future in tile_futures:
+        yield tile_future.result()
+
+    for stage_thread in stage_threads:
+        stage_thread.join()
@@ -2,23 +2,104 @@
 Author: Resul Emre AYGAN
 """
 
-from json import dump, load
-from os import makedirs, path, remove
+import gzip
+from hashlib import sha256
+from json import dump, load, dumps, loads, JSONDecodeError
+from os import makedirs, path, remove, stat
 from uuid import uuid4
 
+from utils.metric_operations import profile_stage, add_counter
+
 
 def write_json(output_path, json_data):
     with open(output_path, "w") as f:
         dump(json_data, f, indent=4)
 
 
+@profile_stage(stage_name="file_write")
+def write_bytes(output_path, data):
+    with open(output_path, "wb") as f:
+        f.write(data)
+
+    add_counter(counter_name="bytes_written", value=len(data))
+
+
 def load_json(json_path):
-    with open(json_path) as json_data_file:
+    with (gzip.open(json_path, "rt") if json_path.endswith(".gz") else open(json_path)) as json_data_file:
         data = load(json_data_file)
 
     return data
 
 
+def append_json_line(output_path, json_data):
+    with open(output_path, "a") as f:
+        f.write(dumps(json_data, separators=(",", ":")) + "\n")
+        f.flush()
+
+
+def iter_json_lines(json_path):
+    # lines are yielded with their byte offset so a caller can read one of them again later with load_json_line
+    with open(json_path, "rb") as json_data_file:
+        line_offset = 0
+
+        for line in json_data_file:
+            try:
+                yield line_offset, loads(line)
+            except JSONDecodeError:
+                # the last line can be cut short if the run was killed while writing it
+                pass
+
+            line_offset += len(line)
+
+
+def repair_json_lines(json_path):
+    # a run killed while writing leaves a partial last line, the next append would be glued onto it
+    valid_end = 0
+
+    with open(json_path, "r+b") as json_data_file:
+        line_end = 0
+
+        for line in json_data_file:
+            line_end += len(line)
+
+            try:
+                loads(line)
+                valid_end = line_end
+            except JSONDecodeError:
+                continue
+
+        json_data_file.truncate(valid_end)
+
+        if valid_end:
+            json_data_file.seek(valid_end - 1)
+
+            if json_data_file.read(1) != b"\n":
+                json_data_file.write(b"\n")
+
+
+def load_json_line(json_path, line_offset):
+    with open(json_path, "rb") as json_data_file:
+        json_data_file.seek(line_offset)
+
+        return loads(json_data_file.readline())
+
+
+def file_checksum(file_path, chunk_size=1024 * 1024):
+    checksum = sha256()
+
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            checksum.update(chunk)
+
+    return checksum.hexdigest()
+
+
+def file_signature(file_path):
+    file_stat = stat(file_path)
+
+    return [file_stat.st_size, file_stat.st_mtime_ns]
+
+
 def delete_file(file_path):
     if path.exists(file_path):
         remove(file_path)
@@ -28,6 +109,14 @@ def file_exists(file_path):
     return path.exists(file_path)
 
 
+def get_file_size(file_path):
+    return path.getsize(file_path)
+
+
+def get_relative_path(file_path, dir_path):
+    return path.relpath(file_path, dir_path)
+
+
 def is_dir(dir_path):
     return path.isdir(dir_path)
 
@@ -2,9 +2,26 @@
 Author: Resul Emre AYGAN
 """
 
+from glob import glob, has_magic
+
 from utils.file_operations import file_exists, load_json, is_dir, is_file, generate_dir
 
 
+def expand_raster_paths(raster_path):
+    if isinstance(raster_path, str):
+        raster_path = [raster_path]
+
+    raster_paths = []
+
+    for path_pattern in raster_path:
+        if has_magic(path_pattern):
+            raster_paths.extend(sorted(glob(path_pattern)))
+        else:
+            raster_paths.append(path_pattern)
+
+    return list(dict.fromkeys(raster_paths))
+
+
 def load_config():
     try:
         if not file_exists(file_path="config.json"):
@@ -12,22 +29,68 @@ def load_config():
 
         data = load_json(json_path="config.json")
 
-        save_as_png = data["save_as_png"]
-        output_dir = data["output_dir"]
-        crop_size_x = data["crop_size_x"]
-        crop_size_y = data["crop_size_y"]
-        crop_shape = data["crop_shape"]
-        shape_path = data["shape_path"]
-        raster_format = data["raster_format"]
-        raster_path = data["raster_path"]
-        seg_mask = data["seg_mask"]
-        seg_mask_as_png = data["seg_mask_as_png"]
-        convert_coco = data["convert_coco"]
-        visualize_coco = data["visualize_coco"]
-        coco_ann_path = data["coco_annotations_path"]
-        coco_ann_image_path = data["annotations_image_dir_path"]
-        drawn_annotations_path = data["drawn_annotations_path"]
-        calculate_annotations_analysis = data["calculate_annotations_analysis"]
+        config = {
+            "save_as_png": data["save_as_png"],
+            "output_dir": data["output_dir"],
+            "crop_size_x": data["crop_size_x"],
+            "crop_size_y": data["crop_size_y"],
+            "crop_shape": data["crop_shape"],
+            "shape_path": data["shape_path"],
+            "raster_format": data["raster_format"],
+            "raster_paths": expand_raster_paths(raster_path=data["raster_path"]),
+            "seg_mask": data["seg_mask"],
+            "seg_mask_as_png": data["seg_mask_as_png"],
+            "convert_coco": data["convert_coco"],
+            "visualize_coco": data["visualize_coco"],
+            "coco_annotations_path": data["coco_annotations_path"],
+            "annotations_image_dir_path": data["annotations_image_dir_path"],
+            "drawn_annotations_path": data["drawn_annotations_path"],
+            "calculate_annotations_analysis": data["calculate_annotations_analysis"],
+            # later keys have defaults so older config files keep working
+            "num_workers": data.get("num_workers", 1),
+            "window_read": data.get("window_read", True),
+            "save_tile_raster": data.get("save_tile_raster", True),
+            "coco_compact": data.get("coco_compact", False),
+            "coco_gzip": data.get("coco_gzip", False),
+            "skip_empty_tiles": data.get("skip_empty_tiles", False),
+            "skip_tiles_without_features": data.get("skip_tiles_without_features", False),
+            "virtual_reprojection": data.get("virtual_reprojection", True),
+            "pipeline": data.get("pipeline", False),
+            "prefetch_queue_size": data.get("prefetch_queue_size", 4),
+            "encoder_workers": data.get("encoder_workers", 2),
+            "write_queue_size": data.get("write_queue_size", 16),
+            "png_backend": data.get("png_backend", "pil"),
+            "png_compression": data.get("png_compression", 6),
+            "annotation_engine": data.get("annotation_engine", "contours"),
+            "profile_stages": data.get("profile_stages", []),
+            "raster_profile": data.get("raster_profile", "plain"),
+            "raster_compression": data.get("raster_compression", "NONE"),
+            "mosaic_cog": data.get("mosaic_cog", False),
+            "shard_output": data.get("shard_output", False),
+            "shard_size": data.get("shard_size", 1000),
+            "tile_overlap": data.get("tile_overlap", 0),
+            "tile_edge_mode": data.get("tile_edge_mode", "pad"),
+            "deduplicate_annotations": data.get("deduplicate_annotations", True),
+            "pyramid_levels": data.get("pyramid_levels", [1]),
+        }
+
+        output_dir = config["output_dir"]
+        num_workers = config["num_workers"]
+        png_backend = config["png_backend"]
+        png_compression = config["png_compression"]
+        annotation_engine = config["annotation_engine"]
+        profile_stages = config["profile_stages"]
+        raster_profile = config["raster_profile"]
+        raster_compression = config["raster_compression"]
+        shard_size = config["shard_size"]
+        tile_overlap = config["tile_overlap"]
+        tile_edge_mode = config["tile_edge_mode"]
+        pyramid_levels = config["pyramid_levels"]
+        crop_size_x = config["crop_size_x"]
+        crop_size_y = config["crop_size_y"]
+        coco_ann_path = config["coco_annotations_path"]
+        coco_ann_image_path = config["annotations_image_dir_path"]
+        drawn_annotations_path = config["drawn_annotations_path"]
 
         if not is_dir(dir_path=output_dir):
             raise Exception(f"Cikti dosya yolu dizin degil!")
@@ -35,13 +98,68 @@ def load_config():
         if not file_exists(file_path=output_dir):
             generate_dir(dir_path=output_dir)
 
-        if crop_shape:
-            if not is_file(file_path=shape_path):
+        if not isinstance(num_workers, int) or num_workers < 1:
+            raise Exception(f"Islemci sayisi 1 veya daha buyuk bir tam sayi olmali! - {num_workers}")
+
+        if config["pipeline"] and num_workers > 1:
+            raise Exception(f"pipeline modu tek islemcide calisir, num_workers 1 olmali! - {num_workers}")
+
+        for queue_name in ["prefetch_queue_size", "encoder_workers", "write_queue_size"]:
+            queue_value = config[queue_name]
+
+            if not isinstance(queue_value, int) or queue_value < 1:
+                raise Exception(f"{queue_name} 1 veya daha buyuk bir tam sayi olmali! - {queue_value}")
+
+        if png_backend not in ["pil", "gdal", "matplotlib"]:
+            raise Exception(f"png_backend pil, gdal veya matplotlib olmali! - {png_backend}")
+
+        if not isinstance(png_compression, int) or not 0 <= png_compression <= 9:
+            raise Exception(f"png_compression 0 ile 9 arasinda bir tam sayi olmali! - {png_compression}")
+
+        if annotation_engine not in ["contours", "components", "vectors"]:
+            raise Exception(f"annotation_engine contours, components veya vectors olmali! - {annotation_engine}")
+
+        if not isinstance(profile_stages, list) or not all(isinstance(val, str) for val in profile_stages):
+            raise Exception(f"profile_stages asama adlarindan olusan bir liste olmali! - {profile_stages}")
+
+        if raster_profile not in ["plain", "tiled", "cog"]:
+            raise Exception(f"raster_profile plain, tiled veya cog olmali! - {raster_profile}")
+
+        if raster_compression not in ["NONE", "DEFLATE", "ZSTD", "LZW"]:
+            raise Exception(f"raster_compression NONE, DEFLATE, ZSTD veya LZW olmali! - {raster_compression}")
+
+        if not isinstance(shard_size, int) or shard_size < 1:
+            raise Exception(f"shard_size 1 veya daha buyuk bir tam sayi olmali! - {shard_size}")
+
+        if not isinstance(tile_overlap, int) or not 0 <= tile_overlap < min(crop_size_x, crop_size_y):
+            raise Exception(f"tile_overlap 0 ile parca boyutu arasinda bir tam sayi olmali! - {tile_overlap}")
+
+        if tile_edge_mode not in ["pad", "shift"]:
+            raise Exception(f"tile_edge_mode pad veya shift olmali! - {tile_edge_mode}")
+
+        if not isinstance(pyramid_levels, list) or 1 not in pyramid_levels or \
+                not all(isinstance(val, int) and val >= 1 for val in pyramid_levels):
+            raise Exception(f"pyramid_levels 1'i iceren pozitif tam sayilardan olusan bir liste olmali! - "
+                            f"{pyramid_levels}")
+
+        if any(crop_size_x % val or crop_size_y % val for val in pyramid_levels):
+            raise Exception(f"Parca boyutu pyramid_levels degerlerine tam bolunmeli! - {pyramid_levels}")
+
+        config["pyramid_levels"] = sorted(set(pyramid_levels))
+
+        if not config["raster_paths"]:
+            raise Exception(f"Raster dosya yolu bulunamadi! - {data['raster_path']}")
+
+        if not config["save_as_png"] and not config["save_tile_raster"]:
+            raise Exception(f"save_as_png ve save_tile_raster parametrelerinden en az biri true olmali!")
+
+        if config["crop_shape"]:
+            if not is_file(file_path=config["shape_path"]):
                 raise Exception(f"Shapefile dosya yolunda hata var!")
         else:
-            convert_coco = False
+            config["convert_coco"] = False
 
-        if visualize_coco:
+        if config["visualize_coco"]:
             if not file_exists(file_path=coco_ann_path):
                 raise Exception(f"Coco etiket verisi bulunamadi! - {coco_ann_path}")
 
@@ -54,8 +172,6 @@ def load_config():
             if not is_dir(dir_path=drawn_annotations_path):
                 raise Exception(f"Coco cikti dosya yolu dizin olmalidir! - {drawn_annotations_path}")
 
-        return [save_as_png, output_dir, crop_size_x, crop_size_y, crop_shape, shape_path, raster_format, raster_path,
-                seg_mask, seg_mask_as_png, convert_coco, visualize_coco, coco_ann_path, coco_ann_image_path,
-                drawn_annotations_path, calculate_annotations_analysis]
+        return config
     except Exception as error:
         raise Exception(f"Konfig dosyasi yuklenirken hata olustu! - Hata: {error}")
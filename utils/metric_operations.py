@@ -0,0 +1,170 @@
+"""
+Author: Resul Emre AYGAN
+"""
+
+from cProfile import Profile
+from contextlib import contextmanager
+from functools import wraps
+from os import path
+from pstats import Stats
+from threading import Lock, local, get_ident
+from time import perf_counter
+
+# timings and counters of this process, pool workers send theirs back with every tile result
+stage_metrics = {}
+counter_metrics = {}
+metrics_lock = Lock()
+
+profile_stages = set()
+stage_profiles = {}
+merged_profiles = {}
+profile_state = local()
+
+
+def set_profile_stages(stage_names):
+    profile_stages.clear()
+    profile_stages.update(stage_names)
+
+
+def is_stage_profiled(stage_name):
+    # nested stages are already covered by the outer profile, a thread can only run one profiler at a time
+    return ((stage_name in profile_stages or "all" in profile_stages) and
+            not getattr(profile_state, "active", False))
+
+
+@contextmanager
+def measure_stage(stage_name):
+    profiler = None
+
+    if is_stage_profiled(stage_name=stage_name):
+        # a profiler can only be enabled on one thread, pipeline threads get their own and they are merged on dump
+        with metrics_lock:
+            profiler = stage_profiles.setdefault((stage_name, get_ident()), Profile())
+
+        profile_state.active = True
+        profiler.enable()
+
+    start_time = perf_counter()
+
+    try:
+        yield
+    finally:
+        elapsed_time = perf_counter() - start_time
+
+        if profiler is not None:
+            profiler.disable()
+            profile_state.active = False
+
+        with metrics_lock:
+            stage_metric = stage_metrics.setdefault(stage_name, {"count": 0, "seconds": 0.0})
+            stage_metric["count"] += 1
+            stage_metric["seconds"] += elapsed_time
+
+
+def profile_stage(stage_name):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with measure_stage(stage_name=stage_name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def reset_metrics(stage_names=()):
+    # forked pool workers start with a copy of the parent's metrics, they are cleared so nothing is counted twice
+    with metrics_lock:
+        stage_metrics.clear()
+        counter_metrics.clear()
+        stage_profiles.clear()
+        merged_profiles.clear()
+
+    set_profile_stages(stage_names=stage_names)
+
+
+def add_counter(counter_name, value=1):
+    with metrics_lock:
+        counter_metrics[counter_name] = counter_metrics.get(counter_name, 0) + int(value)
+
+
+def get_stage_stats():
+    stage_stats = {}
+
+    for (stage_name, _), profiler in stage_profiles.items():
+        if stage_name in stage_stats:
+            stage_stats[stage_name].add(profiler)
+        else:
+            stage_stats[stage_name] = Stats(profiler)
+
+    return stage_stats
+
+
+def take_metrics():
+    with metrics_lock:
+        metrics = {"stages": {stage_name: dict(stage_metric) for stage_name, stage_metric in stage_metrics.items()},
+                   "counters": dict(counter_metrics)}
+
+        # profiles travel as the plain dicts pstats dumps, the main process merges them and writes each stage once
+        if stage_profiles:
+            metrics["profiles"] = {stage_name: stats.stats for stage_name, stats in get_stage_stats().items()}
+
+        stage_metrics.clear()
+        counter_metrics.clear()
+        stage_profiles.clear()
+
+    return metrics
+
+
+def merge_metrics(metrics):
+    if not metrics:
+        return
+
+    with metrics_lock:
+        for stage_name, stage_metric in metrics["stages"].items():
+            merged_metric = stage_metrics.setdefault(stage_name, {"count": 0, "seconds": 0.0})
+            merged_metric["count"] += stage_metric["count"]
+            merged_metric["seconds"] += stage_metric["seconds"]
+
+        for counter_name, value in metrics["counters"].items():
+            counter_metrics[counter_name] = counter_metrics.get(counter_name, 0) + value
+
+        for stage_name, profile_stats in metrics.get("profiles", {}).items():
+            stats = Stats()
+            stats.stats = profile_stats
+            stats.get_top_level_stats()
+
+            if stage_name in merged_profiles:
+                merged_profiles[stage_name].add(stats)
+            else:
+                merged_profiles[stage_name] = stats
+
+
+def get_metrics_report(wall_seconds):
+    with metrics_lock:
+        stages = {stage_name: {**stage_metric, "mean_seconds": stage_metric["seconds"] / stage_metric["count"]}
+                  for stage_name, stage_metric in sorted(stage_metrics.items(),
+                                                         key=lambda val: val[1]["seconds"], reverse=True)}
+
+        return {"wall_seconds": wall_seconds, "stages": stages, "counters": dict(sorted(counter_metrics.items()))}
+
+
+def dump_stage_profiles(output_dir):
+    profile_paths = []
+
+    with metrics_lock:
+        stage_stats = get_stage_stats()
+
+        for stage_name, stats in merged_profiles.items():
+            if stage_name in stage_stats:
+                stage_stats[stage_name].add(stats)
+            else:
+                stage_stats[stage_name] = stats
+
+        for stage_name, stats in stage_stats.items():
+            profile_path = path.join(output_dir, f'{stage_name}.prof')
+            stats.dump_stats(profile_path)
+            profile_paths.append(profile_path)
+
+    return profile_paths
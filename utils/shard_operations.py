@@ -0,0 +1,210 @@
+"""
+Author: Resul Emre AYGAN
+"""
+
+import tarfile
+from glob import glob, escape
+from hashlib import sha256
+from io import BytesIO
+from json import dumps
+from os import path
+from threading import Lock
+from time import time
+
+from utils.file_operations import append_json_line, delete_file, file_exists, file_checksum, get_file_name_with_ext, \
+    file_signature, repair_json_lines
+from utils.metric_operations import profile_stage, add_counter
+
+shapefile_sidecars = [".shx", ".dbf", ".prj", ".cpg"]
+
+# shards are opened once per process for reading, members are looked up in the parsed header list
+shard_files = {}
+shard_lock = Lock()
+
+
+def get_shard_name(shard_prefix, shard_index):
+    return f'{shard_prefix}_{shard_index:05d}.tar'
+
+
+def get_shard_paths(output_dir, shard_prefix):
+    return sorted(glob(path.join(escape(output_dir), escape(shard_prefix) + '_[0-9][0-9][0-9][0-9][0-9].tar')))
+
+
+def open_shard_writer(output_dir, shard_prefix, shard_size, resume=False):
+    index_path = path.join(output_dir, shard_prefix + '_shards.jsonl')
+
+    if not resume:
+        for shard_path in get_shard_paths(output_dir=output_dir, shard_prefix=shard_prefix):
+            delete_file(file_path=shard_path)
+
+        delete_file(file_path=index_path)
+    elif file_exists(file_path=index_path):
+        repair_json_lines(json_path=index_path)
+
+    # a resumed run never appends to an existing shard, the last one may have been cut short
+    return {"output_dir": output_dir, "shard_prefix": shard_prefix, "shard_size": shard_size,
+            "shard_index": len(get_shard_paths(output_dir=output_dir, shard_prefix=shard_prefix)),
+            "shard_name": None, "tar_file": None, "tile_count": 0, "index_path": index_path}
+
+
+def get_output_files(output_path):
+    output_files = [output_path]
+
+    if output_path.endswith('.shp'):
+        output_files.extend(sidecar_path for sidecar_path in (output_path[:-4] + ext for ext in shapefile_sidecars)
+                            if file_exists(file_path=sidecar_path))
+
+    return output_files
+
+
+def add_shard_member(tar_file, member_name, file_object, size):
+    tar_info = tarfile.TarInfo(name=member_name)
+    tar_info.size = size
+    tar_info.mtime = int(time())
+
+    tar_file.addfile(tar_info, file_object)
+
+    # the data of a member ends on a 512 byte block, loaders can seek to it without parsing the tar headers
+    return {"offset": tar_file.offset - ((size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE,
+            "size": size, "mtime": tar_info.mtime}
+
+
+@profile_stage(stage_name="shard_write")
+def write_shard_tile(shard_writer, tile_result):
+    if shard_writer["tar_file"] is None:
+        shard_writer["shard_name"] = get_shard_name(shard_prefix=shard_writer["shard_prefix"],
+                                                    shard_index=shard_writer["shard_index"])
+        shard_writer["tar_file"] = tarfile.open(path.join(shard_writer["output_dir"], shard_writer["shard_name"]), "w")
+
+    tar_file = shard_writer["tar_file"]
+    shard_path = path.join(shard_writer["output_dir"], shard_writer["shard_name"])
+
+    members = {}
+    shard_file_paths = {}
+    shard_signatures = {}
+
+    for output_path in tile_result["outputs"]:
+        for file_path in get_output_files(output_path=output_path):
+            if not file_exists(file_path=file_path):
+                continue
+
+            member_name = get_file_name_with_ext(file_path=file_path)
+
+            with open(file_path, "rb") as f:
+                members[member_name] = add_shard_member(tar_file=tar_file, member_name=member_name, file_object=f,
+                                                        size=path.getsize(file_path))
+
+            shard_file_paths[file_path] = path.join(shard_path, member_name)
+
+            # the size and mtime in the member's tar header stand in for the file's stat on a resumed run
+            shard_signatures[file_path] = [members[member_name]["size"], members[member_name]["mtime"]]
+            delete_file(file_path=file_path)
+
+    metadata = dumps({"tile_name": tile_result["tile_name"], "width": tile_result["width"],
+                      "height": tile_result["height"], "annotations": tile_result["annotations"]}).encode()
+    members[tile_result["tile_name"] + '.json'] = add_shard_member(tar_file=tar_file,
+                                                                   member_name=tile_result["tile_name"] + '.json',
+                                                                   file_object=BytesIO(metadata), size=len(metadata))
+
+    # the index line is only written once the members are on disk, so a resumed run can trust it
+    tar_file.fileobj.flush()
+    append_json_line(output_path=shard_writer["index_path"],
+                     json_data={"tile_name": tile_result["tile_name"], "shard": shard_writer["shard_name"],
+                                "members": members})
+
+    add_counter(counter_name="shard_members", value=len(members))
+
+    for level_result in [tile_result, *tile_result.get("levels", {}).values()]:
+        for key in ["outputs", "image_list", "seg_list", "categories_seg_list"]:
+            if key in level_result:
+                level_result[key] = [shard_file_paths.get(file_path, file_path) for file_path in level_result[key]]
+
+    tile_result["checksums"] = {shard_file_paths.get(file_path, file_path): checksum
+                                for file_path, checksum in tile_result["checksums"].items()}
+
+    tile_result["signatures"] = {shard_file_paths.get(file_path, file_path): shard_signatures.get(file_path, signature)
+                                 for file_path, signature in tile_result["signatures"].items()}
+
+    shard_writer["tile_count"] += 1
+
+    if shard_writer["tile_count"] >= shard_writer["shard_size"]:
+        close_shard_writer(shard_writer=shard_writer)
+
+    return tile_result
+
+
+def close_shard_writer(shard_writer):
+    if shard_writer["tar_file"] is not None:
+        shard_writer["tar_file"].close()
+        shard_writer["tar_file"] = None
+        shard_writer["shard_index"] += 1
+        shard_writer["tile_count"] = 0
+
+
+def split_shard_path(file_path):
+    shard_end = file_path.find('.tar' + path.sep)
+
+    if shard_end == -1:
+        return None, None
+
+    return file_path[:shard_end + 4], file_path[shard_end + 5:]
+
+
+def is_shard_path(file_path):
+    return split_shard_path(file_path=file_path)[0] is not None
+
+
+def get_shard_file(shard_path):
+    tar_file = shard_files.get(shard_path)
+
+    if tar_file is None:
+        tar_file = tarfile.open(shard_path, "r")
+        shard_files[shard_path] = tar_file
+
+    return tar_file
+
+
+def read_shard_file(file_path):
+    shard_path, member_name = split_shard_path(file_path=file_path)
+
+    with shard_lock:
+        return get_shard_file(shard_path=shard_path).extractfile(member_name).read()
+
+
+def close_shard_files():
+    with shard_lock:
+        for tar_file in shard_files.values():
+            tar_file.close()
+
+        shard_files.clear()
+
+
+def get_output_checksum(file_path):
+    if is_shard_path(file_path=file_path):
+        try:
+            return sha256(read_shard_file(file_path=file_path)).hexdigest()
+        except (OSError, KeyError, tarfile.TarError):
+            return None
+
+    if not file_exists(file_path=file_path):
+        return None
+
+    return file_checksum(file_path=file_path)
+
+
+def get_output_signature(file_path):
+    if is_shard_path(file_path=file_path):
+        shard_path, member_name = split_shard_path(file_path=file_path)
+
+        try:
+            with shard_lock:
+                tar_info = get_shard_file(shard_path=shard_path).getmember(member_name)
+        except (OSError, KeyError, tarfile.TarError):
+            return None
+
+        return [tar_info.size, tar_info.mtime]
+
+    if not file_exists(file_path=file_path):
+        return None
+
+    return file_signature(file_path=file_path)